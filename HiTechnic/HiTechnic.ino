@@ -28,6 +28,39 @@ boolean newData = false;
 int intValues[4] = {0};          // Modify the size according to the maximum number of integers expected
 boolean booleanValues[18] = {0}; // Modify the size according to the maximum number of booleans expected
 
+// Binary frames (main.py protocol='binary', layout documented in protocol.py)
+// set to true when the topside sends binary frames instead of "[...]" text
+#define USE_BINARY_FRAMES false
+
+const byte syncByte = 0xA5;
+const byte flagAxes8 = 0x01;
+const byte flagDelta = 0x02;  // only changed fields, listed in a 16 bit mask
+const byte flagSeq = 0x04;    // sequence number + timestamp, answered with an ACK line
+const byte flagTagged = 0x08; // merged frame, a byte with the connected roles follows
+const byte wireAxes = 6;      // INTVALS in protocol.py
+const byte wireButtons = 18;  // BOOLVALS in protocol.py
+const byte buttonBytes = (wireButtons + 7) / 8;
+const byte maxBinaryLen = 9 + 2 * wireAxes + buttonBytes;
+byte receivedBytes[maxBinaryLen];
+
+// Telemetry lines for telemetry.py, sent every telemetryInterval ms:
+//   ENC <m1> <m2> <m3> <m4>   encoder counts of both drivers
+//   PWR <m1> <m2> <m3> <m4>   power last passed to move_power
+// set to true to get them, off by default: reading the encoders and printing the
+// lines takes loop time away from the frames every round
+#define SEND_TELEMETRY false
+const unsigned long telemetryInterval = 100;
+int motorPower[4] = {0};
+
+// Frames mixed on the topside (mixer.py) carry one power per motor in the axes
+// instead of stick values, motor k in axis k. useParsedData applies them like stick
+// values, the brake / full power buttons still override them.
+const int modelMixed = 2;
+
+boolean ackPending = false;  // the last frame was sequenced, echo it once it has been used
+uint16_t ackSeq = 0;
+uint16_t ackStamp = 0;
+
 //============
 
 
@@ -43,6 +76,20 @@ void setup()
 
 void loop()
 {   
+#if USE_BINARY_FRAMES
+    recvBinaryFrame();
+    if (newData == true)
+    {
+        parseBinaryData();
+        useParsedData();
+        if (ackPending)
+        {
+            sendAck();
+            ackPending = false;
+        }
+        newData = false;
+    };
+#else
     recvWithStartEndMarkers();
     if (newData == true)
     {
@@ -53,7 +100,11 @@ void loop()
         useParsedData();
         newData = false;
     };
+#endif
 
+#if SEND_TELEMETRY
+    sendTelemetry();
+#endif
 }
 
 //============
@@ -109,7 +160,8 @@ void parseData()
     switch (modelNum)
     {
     case 0:
-        // Parse the values for Model 0
+    case modelMixed:
+        // Parse the values for Model 0 / motor powers
         for (int i = 0; i < 4; i++)
         {
             strtokIndx = strtok(NULL, ",");
@@ -136,6 +188,157 @@ void parseData()
     }
 }
 
+//============
+
+byte crc8(byte crc, byte data)
+{
+    crc ^= data;
+    for (byte i = 0; i < 8; i++)
+    {
+        crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+    return crc;
+}
+
+void recvBinaryFrame()
+{
+    // 0: waiting for sync, 1: waiting for length, 2: reading body, 3: waiting for crc
+    static byte state = 0;
+    static byte len = 0;
+    static byte ndx = 0;
+    static byte crc = 0;
+    byte rb;
+
+    while (Serial.available() > 0 && newData == false)
+    {
+        rb = Serial.read();
+
+        switch (state)
+        {
+        case 0:
+            if (rb == syncByte)
+            {
+                state = 1;
+            }
+            break;
+        case 1:
+            if (rb < 2 || rb > maxBinaryLen)
+            {
+                state = (rb == syncByte) ? 1 : 0;
+                break;
+            }
+            len = rb;
+            crc = crc8(0, rb);
+            ndx = 0;
+            state = 2;
+            break;
+        case 2:
+            receivedBytes[ndx++] = rb;
+            crc = crc8(crc, rb);
+            if (ndx >= len)
+            {
+                state = 3;
+            }
+            break;
+        case 3:
+            newData = (rb == crc);
+            state = 0;
+            break;
+        }
+    }
+}
+
+//============
+
+void parseBinaryData()
+{
+    static boolean synced = false; // deltas are ignored until a full frame arrived
+    int modelNum = (int8_t)receivedBytes[0];
+    byte flags = receivedBytes[1];
+    byte ndx = 2;
+    uint16_t mask = 0xFFFF; // full frames carry every field
+
+    if (flags & flagSeq)
+    {
+        ackSeq = receivedBytes[ndx] | (receivedBytes[ndx + 1] << 8);
+        ackStamp = receivedBytes[ndx + 2] | (receivedBytes[ndx + 3] << 8);
+        ndx += 4;
+    }
+
+    if (flags & flagTagged)
+    {
+        ndx++; // connected roles, the topside already routed the channels of a missing one
+    }
+
+    if (flags & flagDelta)
+    {
+        if (!synced)
+        {
+            return;
+        }
+        mask = receivedBytes[ndx] | (receivedBytes[ndx + 1] << 8);
+        ndx += 2;
+    }
+
+    switch (modelNum)
+    {
+    case 0:
+    case modelMixed:
+        for (int i = 0; i < wireAxes; i++)
+        {
+            if (!(mask & (1 << i)))
+            {
+                continue;
+            }
+            int val;
+            if (flags & flagAxes8)
+            {
+                val = (int8_t)receivedBytes[ndx++];
+            }
+            else
+            {
+                val = (int16_t)(receivedBytes[ndx] | (receivedBytes[ndx + 1] << 8));
+                ndx += 2;
+            }
+            if (i < 4)
+            {
+                intValues[i] = val;
+            }
+        }
+        for (int g = 0; g < buttonBytes; g++)
+        {
+            if (!(mask & (1 << (8 + g))))
+            {
+                continue;
+            }
+            for (int i = 8 * g; i < 8 * g + 8 && i < 18; i++)
+            {
+                booleanValues[i] = (receivedBytes[ndx] >> (i % 8)) & 1;
+            }
+            ndx++;
+        }
+        if (!(flags & flagDelta))
+        {
+            synced = true;
+        }
+        ackPending = (flags & flagSeq) != 0;
+        break;
+
+    default:
+        // Handle unknown model or invalid data
+        break;
+    }
+}
+
+// "ACK <seq> <stamp>", matched to the send by latency.py
+void sendAck()
+{
+    Serial.print("ACK ");
+    Serial.print(ackSeq);
+    Serial.print(" ");
+    Serial.println(ackStamp);
+}
+
 void useParsedData()
 {   
     // Map the integer values
@@ -156,6 +359,38 @@ void useParsedData()
     */
     Driver1.move_power(mappedVal0, mappedVal1);
     Driver2.move_power(mappedVal2, mappedVal3);
-    
+
+    motorPower[0] = mappedVal0;
+    motorPower[1] = mappedVal1;
+    motorPower[2] = mappedVal2;
+    motorPower[3] = mappedVal3;
+}
+
+//============
+
+void sendTelemetry()
+{
+    static unsigned long lastSent = 0;
+    if (millis() - lastSent < telemetryInterval)
+    {
+        return;
+    }
+    lastSent = millis();
+
+    Serial.print("ENC ");
+    Serial.print(Driver1.get_current_encoder_value(1));
+    Serial.print(" ");
+    Serial.print(Driver1.get_current_encoder_value(2));
+    Serial.print(" ");
+    Serial.print(Driver2.get_current_encoder_value(1));
+    Serial.print(" ");
+    Serial.println(Driver2.get_current_encoder_value(2));
+
+    Serial.print("PWR ");
+    for (int i = 0; i < 4; i++)
+    {
+        Serial.print(motorPower[i]);
+        Serial.print(i < 3 ? " " : "\n");
+    }
 }
 
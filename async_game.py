@@ -0,0 +1,286 @@
+import sys
+import asyncio
+from time import perf_counter
+
+from main import Game, RouteOutput, FPS
+from channels import Route
+from serial_link import LinkDown, LineSplitter
+
+# asyncio variant of Game.
+#
+# Event pumping, sampling of each controller, serial transmit and serial receive run
+# as separate coroutines on one event loop, so a slow read never delays the next
+# write and the other way around. Each controller gets its own sampling task, one
+# more task merges them into the frame sent per tick (see main.Multiplexer), through
+# the filter, the mixer and the session log like Game does (Game.merge_frame).
+
+
+# Non-blocking wrapper around a pyserial port (or a tcp:// / udp:// one, see transport.py).
+#
+# The port is opened with timeout=0 / write_timeout=0 so reads and writes return
+# immediately, waiting is done on the event loop. On posix the file descriptor is
+# watched with add_reader/add_writer, elsewhere the port is polled every `poll` seconds.
+
+
+class AsyncSerialTransport:
+    def __init__(self, com, baud, settle=6, poll=0.002, backoff_min=0.5, backoff_max=8):
+        self.com = com
+        self.baud = baud
+        self.settle = settle
+        self.poll = poll
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self.ser = None
+        self.fd = None
+        self.state = 'down'
+        self.connects = 0
+        self.disconnects = 0
+        self.last_error = None
+        self._up = asyncio.Event()
+        self._down = asyncio.Event()
+        self._waiters = {}  # future -> (fd, remove) of the reads / writes parked on the port
+
+    async def connect(self):
+        from transport import open_port
+
+        delay = self.backoff_min
+        while True:
+            self.state = 'connecting'
+            try:
+                ser = open_port(self.com, self.baud, timeout=0, write_timeout=0)
+            except (OSError, ValueError) as e:
+                self.last_error = e
+                self.state = 'down'
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.backoff_max)
+                continue
+
+            self.state = 'settling'
+            await asyncio.sleep(self.settle if getattr(ser, 'resets_on_open', True) else 0)
+            self.ser = ser
+            try:
+                self.fd = ser.fileno()
+            except (AttributeError, OSError):
+                self.fd = None
+            self.connects += 1
+            self.state = 'up'
+            self._down.clear()
+            self._up.set()
+            return
+
+    async def keep_connected(self):
+        while True:
+            if not self._up.is_set():
+                await self.connect()
+            await self._down.wait()
+
+    def _lost(self, error):
+        if self.ser is None:
+            return
+        self._up.clear()
+        self._down.set()
+        self.state = 'down'
+        self.disconnects += 1
+        self.last_error = error
+        # unpark everyone waiting on the old fd before it is closed (and maybe reused)
+        for ready, (fd, remove) in list(self._waiters.items()):
+            remove(fd)
+            if not ready.done():
+                ready.set_result(None)
+        self._waiters.clear()
+        try:
+            self.ser.close()
+        except OSError:
+            pass
+        self.ser = None
+        self.fd = None
+
+    async def _wait_io(self, add, remove):
+        fd = self.fd
+        if fd is None:
+            await asyncio.sleep(self.poll)
+            return
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        self._waiters[ready] = (fd, remove)
+        try:
+            await ready
+        finally:
+            # _lost() already removed it if the port went away meanwhile
+            if self._waiters.pop(ready, None) is not None:
+                remove(fd)
+
+    async def wait_up(self):
+        await self._up.wait()
+
+    async def write(self, data):
+        await self._up.wait()
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            if (ser := self.ser) is None:
+                raise LinkDown(f'{self.com} is {self.state}')
+            try:
+                n = ser.write(view)
+            except OSError as e:
+                self._lost(e)
+                raise
+            view = view[n or 0:]
+            if view:
+                await self._wait_io(loop.add_writer, loop.remove_writer)
+        return len(data)
+
+    async def read(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._up.wait()
+            ser = self.ser
+            try:
+                data = ser.read(ser.in_waiting or 1)
+            except OSError as e:
+                self._lost(e)
+                continue
+            if data:
+                return data
+            await self._wait_io(loop.add_reader, loop.remove_reader)
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+        self.state = 'closed'
+
+
+# kwargs go to Game (filters, mixer, record, ownership, settle, ...). One port paced
+# at FPS, so the options of the scheduler, routes and acks are rejected.
+
+class AsyncGame(Game):
+    UNSUPPORTED = ('rates', 'routes', 'latency', 'latency_dump', 'keyboard')
+
+    def __init__(self, com='COM5', baud=9600, sendserial=True, protocol='text', keyframe_interval=20, event_rate=250, **kwargs):
+        unsupported = [key for key in self.UNSUPPORTED if kwargs.get(key)]
+        if kwargs.get('input_mode', 'poll') != 'poll':
+            unsupported.append('input_mode')  # pygame.event.wait would block the event loop
+        if unsupported:
+            raise ValueError(f"AsyncGame does not support {', '.join(unsupported)}")
+        self.event_rate = event_rate
+        self.samplers = {}
+        self.frame = None
+        self.frame_ready = None
+        self.transport = None
+        self.output = None  # encodes the merged frame for the port, like Game's outputs
+        self.connects = 0  # transport.connects at the last frame
+        super().__init__(com, baud, sendserial, protocol, keyframe_interval, **kwargs)
+
+        # counters
+        self.overwritten = 0
+        self.written = 0
+        self.write_time_max = 0.0
+
+    def open_link(self):
+        self.transport = AsyncSerialTransport(self.com, self.baud, settle=self.settle)
+        self.output = RouteOutput(Route(self.com, self.baud), None, self.protocol, self.keyframe_interval, telemetry=self.telemetry)
+
+    def handle_joy_added(self, event):
+        joy = super().handle_joy_added(event)
+        self.samplers[joy.jid] = asyncio.create_task(self.sample(joy))
+        return joy
+
+    def handle_joy_removed(self, event):
+        if (task := self.samplers.pop(event.instance_id, None)) is not None:
+            task.cancel()
+        super().handle_joy_removed(event)
+
+    def post(self, frame):
+        if self.frame is not None:
+            self.overwritten += 1
+        self.frame = frame
+        self.frame_ready.set()
+
+    async def pump_events(self):
+        while not self.done:
+            self.handle_events()
+            await asyncio.sleep(1 / self.event_rate)
+
+    async def sample(self, joystick):
+        while True:
+            joystick.get_data()
+            await asyncio.sleep(1 / FPS)
+
+    async def multiplex(self):
+        while True:
+            if (frame := self.merge_frame()) is not None and self.output is not None:
+                self.output.update(frame)
+                if (data := self.output.next_frame()) is not None:
+                    self.post(data)
+            await asyncio.sleep(1 / FPS)
+
+    async def transmit(self):
+        while True:
+            await self.frame_ready.wait()
+            self.frame_ready.clear()
+            frame, self.frame = self.frame, None
+            # the board reset on reconnect: whole frame now, and send it again when it
+            # did not change (see serial_link.SerialWriter)
+            await self.transport.wait_up()
+            if self.transport.connects != self.connects:
+                self.connects = self.transport.connects
+                if self.output.delta is not None:
+                    self.output.delta.force_keyframe()
+                self.output.sent_version = -1
+            if callable(frame) and (frame := frame()) is None:
+                continue
+            start = perf_counter()
+            try:
+                await self.transport.write(frame)
+            except OSError:
+                if self.frame is None:
+                    self.post(frame)
+                continue
+            self.written += 1
+            self.write_time_max = max(self.write_time_max, perf_counter() - start)
+
+    async def receive(self):
+        splitter = LineSplitter()
+        while True:
+            data = await self.transport.read()
+            now = perf_counter()
+            for line in splitter.feed(data):
+                if not self.telemetry.on_line(line, now):
+                    print(line)
+
+    async def run(self):
+        self.frame_ready = asyncio.Event()
+        tasks = [asyncio.create_task(self.pump_events())]
+        if self.sendserial:
+            tasks += [
+                asyncio.create_task(self.transport.keep_connected()),
+                asyncio.create_task(self.multiplex()),
+                asyncio.create_task(self.transmit()),
+                asyncio.create_task(self.receive()),
+            ]
+        elif self.recorder is not None:
+            tasks.append(asyncio.create_task(self.multiplex()))
+
+        try:
+            await tasks[0]
+        finally:
+            for task in tasks[1:] + list(self.samplers.values()):
+                task.cancel()
+            await asyncio.gather(*tasks[1:], *self.samplers.values(), return_exceptions=True)
+            self.close()
+
+    def close(self):
+        super().close()
+        if self.transport is not None:
+            self.transport.close()
+
+    def start_loop(self):
+        asyncio.run(self.run())
+
+
+if __name__ == "__main__":
+    from cli import main
+    sys.exit(main(['--engine', 'async'] + sys.argv[1:]))
@@ -0,0 +1,449 @@
+import os
+import sys
+import io
+import json
+import math
+import inspect
+import platform
+import argparse
+import contextlib
+import subprocess
+from time import perf_counter, perf_counter_ns, sleep
+
+# Headless benchmarks for the control pipeline: python bench.py [--out results.json]
+#
+# Runs without a window, controllers or a serial port. Controllers read a scripted
+# FakeJoystick, the display uses SDL's dummy driver and the serial link is pyserial's
+# loop:// (or a pty pair). Results are printed / written as JSON, pass an earlier
+# run as --baseline to fail when something got slower than --tolerance allows.
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pygame
+
+import main
+import main_legacy
+from serial_link import SerialConnection, SerialWriter
+from virtual_rov import VirtualROV
+
+STARTUP_BUDGET_MS = 1000  # python start to the first frame on the port, without settle time
+
+
+# Stands in for pygame.joystick.Joystick, values follow a script of the frame number:
+# sticks rest, sweep and hold, triggers squeeze now and then, buttons are tapped.
+# Values are rounded to 2 places like a real pad reports them.
+
+class FakeJoystick:
+    SCRIPT_FRAMES = 300
+
+    def __init__(self, name='PS5 Controller', instance_id=0, numaxes=6, numbuttons=16, numhats=0, guid=''):
+        self.name = name
+        self.instance_id = instance_id
+        self.numaxes = numaxes
+        self.numbuttons = numbuttons
+        self.numhats = numhats
+        self.guid = guid
+        self.frame = 0
+
+    def step(self):
+        self.frame += 1
+
+    def init(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def get_init(self):
+        return True
+
+    def get_instance_id(self):
+        return self.instance_id
+
+    def get_name(self):
+        return self.name
+
+    def get_guid(self):
+        return self.guid
+
+    def get_power_level(self):
+        return 'wired'
+
+    def get_numaxes(self):
+        return self.numaxes
+
+    def get_numbuttons(self):
+        return self.numbuttons
+
+    def get_numhats(self):
+        return self.numhats
+
+    def get_axis(self, i):
+        t = self.frame % self.SCRIPT_FRAMES
+        if i >= 4:  # triggers rest at -1
+            return round(math.sin(math.pi * (t - 200) / 50), 2) if 200 <= t < 250 else -1.0
+        if t < 100:
+            return 0.0
+        if t < 200:
+            return round(math.sin(2 * math.pi * (i + 1) * t / 100), 2)
+        return round(0.5 * (-1) ** i, 2)
+
+    def get_button(self, i):
+        return int((self.frame + 7 * i) % 40 < 3)
+
+    def get_hat(self, i):
+        return (0, 0)
+
+
+# presses or releases one mapped key of a main.Keyboard per frame, cycling through them
+def key_stepper(keyboard):
+    codes = list(keyboard.masks)
+    frame = 0
+
+    def step():
+        nonlocal frame
+        frame += 1
+        keyboard.on_key(codes[frame % len(codes)], (frame // len(codes)) % 2 == 0)
+    return step
+
+
+def measure(func, frames, repeat, step=None):
+    per_frame = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        for _ in range(frames):
+            if step is not None:
+                step()
+            func()
+        per_frame.append((perf_counter_ns() - start) / frames / 1000)
+    per_frame.sort()
+    return {
+        'us_min': round(per_frame[0], 3),
+        'us_median': round(per_frame[len(per_frame) // 2], 3),
+        'us_max': round(per_frame[-1], 3),
+    }
+
+
+def fake_pads(count):
+    return [FakeJoystick('PS5 Controller' if k % 2 else 'Nintendo Switch Pro Controller', k) for k in range(count)]
+
+
+def stepper(pads):
+    def step():
+        for pad in pads:
+            pad.step()
+    return step
+
+
+# get_data cost of one controller, new classes against main_legacy.py
+def bench_get_data(frames, repeat):
+    results = {}
+    for module in (main, main_legacy):
+        for cls in (module.Controller, module.ProController, module.PS5Controller):
+            pad = FakeJoystick()
+            joy = cls(pad)
+            results[f'{module.__name__}.{cls.__name__}'] = measure(joy.get_data, frames, repeat, pad.step)
+    keyboard = main.Keyboard()
+    results['main.Keyboard'] = measure(keyboard.get_data, frames, repeat, key_stepper(keyboard))
+    return results
+
+
+# get_data + building the frame for every protocol, main_legacy.py builds its text
+# frame in debug() / send_serial()
+def bench_encode(frames, repeat):
+    results = {}
+    for protocol in ('text', 'binary', 'delta'):
+        pad = FakeJoystick()
+        joy = main.PS5Controller(pad, protocol=protocol)
+
+        def frame(joy=joy):
+            joy.get_data()
+            if callable(data := joy.next_frame()):
+                data()
+        results[f'main.{protocol}'] = measure(frame, frames, repeat, pad.step)
+
+    pad = FakeJoystick()
+    joy = main_legacy.PS5Controller(pad)
+
+    def legacy_frame():
+        joy.get_data()
+        joy.debug()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['main_legacy.text'] = measure(legacy_frame, frames, repeat, pad.step)
+    return results
+
+
+class NoClock:
+    def tick(self, fps=0):
+        return 0
+
+
+# one main_loop iteration with `pads` controllers, without the FPS sleep.
+# `port` returns (com, reader) for a fresh port, the reader drains the far end.
+def bench_loop(frames, repeat, pads, protocol, port=None):
+    results = {}
+    for cls in (main.Game, main.GameVerbose):
+        game = cls(sendserial=False, protocol=protocol)
+        game.clock = NoClock()
+        fakes = fake_pads(pads)
+        for pad in fakes:
+            joy = game.joysticks[pad.instance_id] = main.Gamepad(pad, main.find_profile(pad.get_name()), protocol=protocol)
+            game.mux.assign(joy)
+        step = stepper(fakes)
+        if port is not None:
+            com, reader = port()
+            game.sendserial = True
+            game.com = com
+            game.open_link(settle=0)
+            game.link.wait_up(5)
+            if reader is not None:
+                step = lambda step=step, reader=reader: step() or reader()
+        if cls is main.GameVerbose:
+            def frame(game=game):
+                game.clear_data()
+                game.main_loop()
+        else:
+            frame = game.main_loop
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[f'main.{cls.__name__}'] = measure(frame, frames, repeat, step)
+        game.close()
+
+    if port is not None:
+        return results
+
+    # the body of main_legacy.main() without the serial port
+    legacy = [main_legacy.PS5Controller(pad) for pad in fake_pads(pads)]
+
+    def legacy_frame():
+        pygame.event.get()
+        for joy in legacy:
+            joy.get_data()
+    results['main_legacy.main'] = measure(legacy_frame, frames, repeat, stepper([joy.controller for joy in legacy]))
+    return results
+
+
+# post -> write through the background writer. `post` is what the control loop pays
+# per frame (frames posted faster than the writer runs coalesce), `roundtrip` waits
+# for each frame to come out at the other end of the port.
+def bench_serial(frames, protocol, com, reader=None):
+    link = SerialConnection(com, 115200, settle=0).start()
+    if not link.wait_up(5):
+        return {'error': f'{com} did not come up: {link.last_error}'}
+    read = reader or link.read_all
+    writer = SerialWriter(link)
+    pad = FakeJoystick()
+    joy = main.PS5Controller(pad, protocol=protocol)
+
+    start = perf_counter_ns()
+    for _ in range(frames):
+        pad.step()
+        joy.get_data()
+        joy.send_serial(writer)
+        read()
+    post_us = (perf_counter_ns() - start) / frames / 1000
+    sleep(0.1)
+    read()
+
+    roundtrip = []
+    for _ in range(min(frames, 500)):
+        pad.step()
+        joy.get_data()
+        if (frame := joy.encode()) is None:  # delta frame with nothing changed
+            continue
+        start = perf_counter_ns()
+        writer.post(frame)
+        received = 0
+        while received < len(frame) and perf_counter_ns() - start < 1e9:
+            if not (data := read()):
+                sleep(0)
+            received += len(data)
+        roundtrip.append((perf_counter_ns() - start) / 1000)
+    roundtrip.sort()
+
+    stats = writer.stats()
+    writer.close()
+    link.close()
+    return {
+        'post_us_per_frame': round(post_us, 3),
+        'roundtrip_us_median': round(roundtrip[len(roundtrip) // 2], 3),
+        'roundtrip_us_p95': round(roundtrip[int(0.95 * (len(roundtrip) - 1))], 3),
+        'roundtrip_us_max': round(roundtrip[-1], 3),
+        'written': stats['written'],
+        'overwritten': stats['overwritten'],
+        'errors': stats['errors'],
+        'write_ms_avg': round(stats['write_ms_avg'], 3),
+    }
+
+
+# What HiTechnic.ino makes of the frames of a scripted run (virtual_rov.py) sent at
+# `rate` Hz over a `baud` link, on a simulated clock so it takes no real time. A frame
+# is sent whenever the input changed, like Controller.next_frame.
+def bench_firmware(frames, protocol, baud=9600, rate=main.FPS):
+    pad = FakeJoystick(name='Nintendo Switch Pro Controller')  # the model the firmware handles
+    joy = main.ProController(pad, protocol=protocol)
+    rov = VirtualROV(baud, binary=protocol != 'text')
+    sent = None
+    t = 0.0
+    for _ in range(frames):
+        pad.step()
+        joy.get_data()
+        if joy.state.version != sent and (frame := joy.encode()) is not None:
+            sent = joy.state.version
+            rov.feed(frame, t)
+        t += 1 / rate
+    rov.run(t + 1)
+    stats = rov.stats()
+    del stats['motors'], stats['command_hz']
+    return stats
+
+
+# Time to first command of a fresh interpreter: from starting python until the first
+# frame arrives at the far end of the port. The child imports main like cli.py does,
+# with one FakeJoystick connected and no settle time.
+STARTUP_CHILD = '''
+import sys
+import math
+{fake}
+import main
+
+game = main.Game(com=sys.argv[1], baud=115200, protocol=sys.argv[2], settle=0)
+pad = FakeJoystick()
+game.mux.assign(game.joysticks.setdefault(0, main.Gamepad(pad, main.find_profile(pad.get_name()), protocol=game.protocol)))
+while True:
+    game.handle_events()
+    game.main_loop()
+'''
+
+
+def bench_startup(repeat, protocol):
+    code = STARTUP_CHILD.format(fake=inspect.getsource(FakeJoystick))
+    times = []
+    for _ in range(repeat):
+        com, read = open_pty()
+        start = perf_counter()
+        child = subprocess.Popen([sys.executable, '-c', code, com, protocol], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                 env=os.environ | {'SDL_VIDEODRIVER': 'dummy', 'SDL_AUDIODRIVER': 'dummy'})
+        try:
+            while not read():
+                if child.poll() is not None or perf_counter() - start > 30:
+                    return {'error': 'no frame from the child'}
+                sleep(0.0005)
+            times.append(1000 * (perf_counter() - start))
+        finally:
+            child.kill()
+            child.wait()
+    times.sort()
+    return {
+        'ms_min': round(times[0], 1),
+        'ms_median': round(times[len(times) // 2], 1),
+        'ms_max': round(times[-1], 1),
+    }
+
+
+# a localhost listener (transport.py) stands in for a companion computer on the tether
+def open_listener(scheme):
+    from transport import listen
+
+    listener = listen(f'{scheme}://127.0.0.1:0')
+    return listener.address, lambda: listener.read(1 << 16)
+
+
+# a pty pair stands in for the arduino, returns the port name and a reader for the other end
+def open_pty():
+    master, slave = os.openpty()
+    os.set_blocking(master, False)
+
+    def read():
+        try:
+            return os.read(master, 4096)
+        except BlockingIOError:
+            return b''
+    return os.ttyname(slave), read
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for group, entries in results.items():
+        for name, result in entries.items():
+            old = baseline.get('results', {}).get(group, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(old, dict):
+                continue
+            for key, unit in (('us_median', 'us'), ('ms_median', 'ms')):
+                if key in old and key in result and result[key] > old[key] * (1 + tolerance):
+                    regressions.append(f"{group}/{name}: {old[key]} -> {result[key]} {unit}")
+    return regressions
+
+
+def main_bench(argv=None):
+    parser = argparse.ArgumentParser(description='Headless control pipeline benchmarks')
+    parser.add_argument('--frames', type=int, default=2000, help='frames per run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the median is reported')
+    parser.add_argument('--pads', type=int, default=2, help='controllers in the loop benchmarks')
+    parser.add_argument('--protocol', default='text', choices=['text', 'binary', 'delta'])
+    parser.add_argument('--serial', default='loop', choices=['loop', 'pty', 'tcp', 'udp', 'none'], help='port for the serial benchmarks')
+    parser.add_argument('--out', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--startup-budget-ms', type=float, default=STARTUP_BUDGET_MS, help='fail when the time to first command is over this')
+    args = parser.parse_args(argv)
+
+    # loop:// echoes frames back into read_serial, which expects the arduino's text,
+    # so the loop benchmarks use a pty whenever there is one
+    ports = {
+        'loop': lambda: ('loop://', None),
+        'pty': open_pty,
+        'tcp': lambda: open_listener('tcp'),
+        'udp': lambda: open_listener('udp'),
+        'none': None,
+    }
+    port = ports[args.serial]
+    loop_port = open_pty if port is not None and hasattr(os, 'openpty') else port
+
+    results = {
+        'get_data': bench_get_data(args.frames, args.repeat),
+        'encode': bench_encode(args.frames, args.repeat),
+        'loop': bench_loop(args.frames, args.repeat, args.pads, args.protocol),
+    }
+    if port is not None:
+        results['loop_serial'] = bench_loop(args.frames, args.repeat, args.pads, args.protocol, loop_port)
+        results['serial'] = {args.protocol: bench_serial(args.frames, args.protocol, *port())}
+    results['firmware'] = {args.protocol: bench_firmware(args.frames, args.protocol)}
+    if hasattr(os, 'openpty'):
+        results['startup'] = {'first_command': bench_startup(args.repeat, args.protocol)}
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'platform': platform.platform(),
+            'frames': args.frames,
+            'repeat': args.repeat,
+            'pads': args.pads,
+            'protocol': args.protocol,
+            'serial': args.serial,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+    failed = False
+    startup = results.get('startup', {}).get('first_command', {})
+    if startup.get('ms_median', 0) > args.startup_budget_ms:
+        print(f"startup: first command after {startup['ms_median']} ms, budget {args.startup_budget_ms} ms", file=sys.stderr)
+        failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'slower: {line}', file=sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,71 @@
+from profiles import AXES_ORDER, BUTTONS_ORDER
+
+# Channel ownership for several controllers driving one vehicle.
+#
+# Every wire axis / button is owned by a role. main.Multiplexer fills each channel
+# from the controller assigned to its owner, a channel whose owner has no controller
+# falls back to the other roles in ROLES order, so a single pad still drives
+# everything.
+
+PILOT = 'pilot'
+COPILOT = 'copilot'
+ROLES = (PILOT, COPILOT)  # bit r of a frame TAG is ROLES[r]
+
+
+class Ownership:
+    def __init__(self, name, axes=None, buttons=None, default=PILOT):
+        self.name = name
+        axes, buttons = axes or {}, buttons or {}
+        for role in list(axes.values()) + list(buttons.values()) + [default]:
+            if role not in ROLES:
+                raise ValueError(f'Unknown role: {role!r}')
+
+        # role index per wire axis / button
+        self.axis_owner = [ROLES.index(axes.get(name, default)) for name in AXES_ORDER]
+        self.button_owner = [ROLES.index(buttons.get(name, default)) for name in BUTTONS_ORDER]
+
+    # (role index, wire axes, wire buttons) owned by each role
+    def plan(self):
+        return [
+            (r, [k for k, owner in enumerate(self.axis_owner) if owner == r],
+             [k for k, owner in enumerate(self.button_owner) if owner == r])
+            for r in range(len(ROLES))
+        ]
+
+
+# one pad drives everything
+SINGLE = Ownership('single')
+
+# the pilot keeps the left side (motors 1 and 2 on HiTechnic.ino), the copilot the right
+# side: R stick, ZR, R and the face buttons (motors 3 and 4)
+SPLIT = Ownership(
+    'split',
+    axes={'R_H': COPILOT, 'R_V': COPILOT, 'ZR': COPILOT},
+    buttons={'A': COPILOT, 'B': COPILOT, 'X': COPILOT, 'Y': COPILOT, 'R': COPILOT, 'ZR': COPILOT, 'R_Stick': COPILOT},
+)
+
+OWNERSHIPS = {o.name: o for o in (SINGLE, SPLIT)}
+
+
+# Routing of wire channels to serial ports, for vehicles with more than one board.
+#
+# Every port gets the full wire layout its firmware parses, channels that are not
+# routed to it stay at rest (0). axes / buttons are lists of wire names, None routes
+# all of them.
+
+class Route:
+    def __init__(self, com, baud, axes=None, buttons=None):
+        self.com = com
+        self.baud = baud
+        self.axes = list(AXES_ORDER) if axes is None else list(axes)
+        self.buttons = list(BUTTONS_ORDER) if buttons is None else list(buttons)
+        for name in self.axes:
+            if name not in AXES_ORDER:
+                raise ValueError(f'Unknown axis: {name!r}')
+        for name in self.buttons:
+            if name not in BUTTONS_ORDER:
+                raise ValueError(f'Unknown button: {name!r}')
+
+    # wire indices of the routed axes and buttons
+    def plan(self):
+        return [AXES_ORDER.index(name) for name in self.axes], [BUTTONS_ORDER.index(name) for name in self.buttons]
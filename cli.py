@@ -0,0 +1,118 @@
+from time import perf_counter
+
+STARTED = perf_counter()  # time to first command is measured from here
+
+import sys
+import argparse
+
+# Command line entry point: python cli.py --com COM6 --baud 57600 [--verbose]
+#
+# Only argparse is imported up front, pygame (and pyserial, see serial_link.py) are
+# loaded once the arguments are good, so --help and typos answer right away. The game
+# reports how long it took from here to the first frame written to the port.
+
+RATE_KEYS = ('input', 'transmit', 'render')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Topside controller for the ROV')
+    parser.add_argument('--com', default='COM6', help='port name, pyserial url, tcp://host:port or udp://host:port')
+    parser.add_argument('--baud', type=int, default=57600)
+    parser.add_argument('--protocol', default='text', choices=['text', 'binary', 'delta'])
+    parser.add_argument('--keyframe-interval', type=int, default=20, help="frames between full frames with --protocol delta")
+    parser.add_argument('--no-serial', action='store_true', help='do not open the port')
+    parser.add_argument('--settle', type=float, default=6, help='seconds to wait after opening a serial port')
+
+    ui = parser.add_mutually_exclusive_group()
+    ui.add_argument('--headless', dest='verbose', action='store_false', help='no window (default)')
+    ui.add_argument('--verbose', dest='verbose', action='store_true', help='window with the controller state and link stats')
+    parser.set_defaults(verbose=False)
+    parser.add_argument('--engine', default='loop', choices=['loop', 'async', 'processes'],
+                        help='main.Game, async_game.AsyncGame or multiproc.run')
+
+    parser.add_argument('--input-mode', default='poll', choices=['poll', 'events'])
+    for key in RATE_KEYS:
+        parser.add_argument(f'--{key}-rate', type=float, help=f'{key} rate in Hz, any rate runs the scheduler')
+
+    parser.add_argument('--keyboard', action='store_true', help='drive with the keyboard (profiles.KEYBOARD), needs --verbose')
+    parser.add_argument('--ownership', default='single', choices=['single', 'split'])
+    parser.add_argument('--mixer', help='json allocation for mixer.load, needs numpy')
+    parser.add_argument('--filter', action='store_true', help='smooth the axes and hold back jitter (filters.AxisFilter)')
+    parser.add_argument('--filter-tau', type=float, default=0.03, help='smoothing time constant in s, 0 turns it off')
+    parser.add_argument('--filter-slew', type=float, help='max axis change per second')
+    parser.add_argument('--filter-hysteresis', type=float, default=3, help='units an axis must move before it is sent')
+    parser.add_argument('--filter-deadzone', type=float, default=0, help='largest deadzone learned at rest, 0 turns it off')
+    parser.add_argument('--latency', action='store_true', help='sequence frames and track acks (binary / delta)')
+    parser.add_argument('--latency-dump', help='write the latency histogram to this json file on exit')
+    parser.add_argument('--record', help='append the frame sent to the ports to this session log')
+    parser.add_argument('--startup-budget-ms', type=float, default=500,
+                        help='warn when the first command takes longer than this plus --settle')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    rates = {key: rate for key in RATE_KEYS if (rate := getattr(args, f'{key}_rate')) is not None} or None
+
+    if args.keyboard and not (args.verbose and args.engine == 'loop'):
+        parser.error('--keyboard needs --verbose and --engine loop, keys only reach a window')
+
+    kwargs = dict(
+        com=args.com, baud=args.baud, protocol=args.protocol, keyframe_interval=args.keyframe_interval,
+        input_mode=args.input_mode, latency=args.latency, latency_dump=args.latency_dump, record=args.record,
+        ownership=args.ownership, settle=args.settle,
+    )
+    if args.filter:
+        from filters import AxisFilter
+        kwargs['filters'] = AxisFilter(args.filter_tau, args.filter_slew, args.filter_hysteresis, deadzone=args.filter_deadzone)
+    if args.mixer:
+        from mixer import load
+        kwargs['mixer'] = load(args.mixer)
+
+    if args.engine == 'async':
+        # one port paced at FPS, no scheduler, acks or first command report
+        unsupported = [flag for flag, given in (
+            ('--verbose', args.verbose),
+            ('--input-mode events', args.input_mode != 'poll'),
+            ('--*-rate', rates is not None),
+            ('--latency', args.latency),
+            ('--latency-dump', args.latency_dump),
+            ('--startup-budget-ms', args.startup_budget_ms != parser.get_default('startup_budget_ms')),
+        ) if given]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)}: not supported by --engine async, use loop or processes")
+        from async_game import AsyncGame
+
+        async_kwargs = {key: value for key, value in kwargs.items() if key not in ('input_mode', 'latency', 'latency_dump')}
+        game = AsyncGame(sendserial=not args.no_serial, **async_kwargs)
+        return run(game)
+
+    if args.engine == 'processes':
+        import multiproc
+
+        multiproc.run(rates, ui=args.verbose, sendserial=not args.no_serial, **kwargs)
+        return 0
+
+    from main import Game, GameVerbose
+
+    cls = GameVerbose if args.verbose else Game
+    game = cls(sendserial=not args.no_serial, rates=rates, keyboard=args.keyboard, **kwargs)
+    game.started = STARTED
+    game.startup_budget_ms = args.startup_budget_ms
+    return run(game)
+
+
+def run(game):
+    import pygame
+
+    try:
+        game.start_loop()
+    except KeyboardInterrupt:
+        game.close()
+    pygame.quit()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
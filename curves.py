@@ -0,0 +1,94 @@
+import math
+
+# Axis response curves compiled to lookup tables.
+#
+# Controller.get_data produces raw axis values as ints in RAW_MIN..RAW_MAX. A
+# ResponseCurve runs every possible raw value once through the shaping stages
+#
+#   inner deadzone -> gain (outer deadzone) -> clamp -> curve -> quantize -> invert -> offset
+#
+# and keeps the results in a table, so shaping a value per frame is one index.
+
+RAW_MIN = -100
+RAW_MAX = 100
+
+
+# Curve shapes work on -1..1 and must map 0 -> 0 and +-1 -> +-1
+
+def linear():
+    return lambda x: x
+
+
+def expo(k):
+    return lambda x: (1 - k) * x + k * x ** 3
+
+
+# piecewise linear curve through (input, output) points on the positive half, mirrored for negative input
+def points(pts):
+    pts = sorted([(0, 0)] + [tuple(p) for p in pts])
+
+    def shape(x):
+        sign, x = math.copysign(1, x), abs(x)
+        for (x0, y0), (x1, y1) in zip(pts, pts[1:]):
+            if x <= x1:
+                return sign * (y0 + (y1 - y0) * (x - x0) / (x1 - x0))
+        return sign * pts[-1][1]
+    return shape
+
+
+# Accepts None / 'linear', ('expo', k), or a list of (input, output) points in -1..1
+def make_curve(spec):
+    match spec:
+        case None | 'linear':
+            return linear()
+        case ('expo', k):
+            return expo(k)
+        case list() | tuple():
+            return points(spec)
+        case _ if callable(spec):
+            return spec
+    raise ValueError(f'Unknown curve: {spec!r}')
+
+
+class ResponseCurve:
+    def __init__(self, deadzone=10, gain=1.0, step=2, curve=None, invert=False, offset=0):
+        self.deadzone = deadzone
+        self.gain = gain
+        self.step = step
+        self.curve = make_curve(curve)
+        self.invert = invert
+        self.offset = offset
+        self.table = [self.shape(v) for v in range(RAW_MIN, RAW_MAX + 1)]
+
+    def shape(self, val):
+        if abs(val) < self.deadzone:
+            val = 0
+        val = max(RAW_MIN, min(RAW_MAX, round(val * self.gain)))
+        val = round(RAW_MAX * self.curve(val / RAW_MAX))
+        val = self.step * round(val / self.step)
+        if self.invert:
+            val = -val
+        return val + self.offset
+
+    def __call__(self, val):
+        return self.table[val - RAW_MIN]
+
+
+# One ResponseCurve per axis in wire order, applied to all axes in a single pass
+
+class AxisCurves:
+    def __init__(self, curves):
+        self.curves = list(curves)
+        self.tables = [c.table for c in self.curves]
+
+    def shape(self, values):
+        return [t[v - RAW_MIN] for t, v in zip(self.tables, values)]
+
+
+def stick_curve(gain=1.0, curve=None, invert=False):
+    return ResponseCurve(deadzone=10, gain=gain, step=2, curve=curve, invert=invert)
+
+
+# analog triggers rest at RAW_MIN and are sent as 0..200
+def trigger_curve():
+    return ResponseCurve(deadzone=0, step=1, offset=-RAW_MIN)
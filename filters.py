@@ -0,0 +1,108 @@
+import math
+from array import array
+from time import perf_counter
+
+from protocol import INTVALS
+from profiles import AXES_ORDER, AXIS_RANGE
+
+# Per-axis filtering of the merged wire axes, Game(filters=AxisFilter(...)).
+#
+# Shaped stick values jitter by a quantization step near rest and near step edges, and
+# every flip is a new frame on the link. Each axis goes through
+#
+#   adaptive deadzone -> exponential smoothing (tau) -> slew limit -> hysteresis
+#
+# The deadzone is learned at rest: while the filtered axis sits at 0 the peak |value|
+# seen (up to `deadzone`, decaying by `deadzone_decay` per tick) is treated as noise.
+# The output only moves when the filtered value is `hysteresis` away from it, except
+# that an input at rest or at an end of its range is passed exactly once the filter
+# has converged on it, so a released stick always sends 0 and full stick reaches 100.
+# Parameters are one value for every axis or one per wire axis, 0 / None turns a
+# stage off. All state is in arrays allocated up front.
+
+
+def _per_axis(value, default=0):
+    if value is None:
+        value = default
+    if isinstance(value, (int, float)):
+        return [value] * INTVALS
+    if len(value) != INTVALS:
+        raise ValueError(f'expected {INTVALS} values, got {len(value)}')
+    return [default if v is None else v for v in value]
+
+
+class AxisFilter:
+    def __init__(self, tau=0.03, slew=None, hysteresis=3, step=2, deadzone=0, deadzone_decay=0.999, clock=perf_counter):
+        self.tau = _per_axis(tau)                # smoothing time constant, s
+        self.slew = _per_axis(slew)              # max change, units / s
+        self.hysteresis = _per_axis(hysteresis)  # units the output holds against
+        self.step = step                         # quantization of the output (the curves' step)
+        self.deadzone = _per_axis(deadzone)      # largest deadzone that may be learned, units
+        self.deadzone_decay = deadzone_decay
+        self.clock = clock
+        self.ends = [AXIS_RANGE[name] for name in AXES_ORDER]
+
+        self.ema = array('d', [0.0]) * INTVALS
+        self.slewed = array('d', [0.0]) * INTVALS
+        self.noise = array('d', [0.0]) * INTVALS
+        self.out = array('h', [0]) * INTVALS
+        self.last_tick = None
+
+        # counters
+        self.ticks = 0
+        self.changes = 0  # output values changed
+
+    # filters one tick of wire axes, returns the output array (valid until the next call)
+    def apply(self, values):
+        now = self.clock()
+        first = self.last_tick is None
+        dt = 0.0 if first else now - self.last_tick
+        self.last_tick = now
+        self.ticks += 1
+        step = self.step
+
+        for k in range(INTVALS):
+            x = values[k]
+
+            if limit := self.deadzone[k]:
+                dev = abs(x)
+                if self.out[k] == 0 and dev <= limit:
+                    self.noise[k] = max(self.noise[k] * self.deadzone_decay, dev)
+                if dev <= self.noise[k]:
+                    x = 0
+
+            tau = self.tau[k]
+            if first or not tau:
+                ema = x
+            else:
+                ema = self.ema[k] + (1 - math.exp(-dt / tau)) * (x - self.ema[k])
+            self.ema[k] = ema
+
+            slew = self.slew[k]
+            if first or not slew:
+                y = ema
+            else:
+                y = self.slewed[k]
+                y += max(-slew * dt, min(slew * dt, ema - y))
+            self.slewed[k] = y
+
+            out = self.out[k]
+            if first:
+                new = x
+            elif (x == 0 or x in self.ends[k]) and abs(y - x) < step / 2:
+                new = x
+            elif abs(y - out) >= self.hysteresis[k]:
+                new = step * round(y / step)
+            else:
+                continue
+            if new != out:
+                self.out[k] = new
+                self.changes += 1
+        return self.out
+
+    def stats(self):
+        return {
+            'ticks': self.ticks,
+            'changes': self.changes,
+            'deadzone': [round(v, 1) for v in self.noise],
+        }
@@ -0,0 +1,130 @@
+import json
+import threading
+from array import array
+from time import perf_counter
+
+# End to end latency of sequenced frames.
+#
+# The writer asks next_seq() for the (seq, stamp) of the frame it is about to encode
+# and calls on_send() once the frame is really going out. The firmware answers each
+# sequenced frame it acted on with "ACK <seq> <stamp>", on_line() matches that to the
+# send and adds the round trip to a histogram of BIN_MS wide bins. A send that is not
+# acked within `timeout` seconds counts as lost.
+
+BIN_MS = 0.5
+MAX_MS = 1000
+
+# bucket edges in ms for the compact histogram shown in GameVerbose
+COARSE_EDGES = (2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class LatencyTracker:
+    def __init__(self, timeout=1.0, clock=perf_counter):
+        self.timeout = timeout
+        self.clock = clock
+        self.bins = array('I', [0]) * (int(MAX_MS / BIN_MS) + 1)  # last bin is everything above MAX_MS
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._inflight = {}  # seq -> (stamp, send time)
+
+        # counters
+        self.sent = 0
+        self.acked = 0
+        self.lost = 0
+        self.unmatched = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def next_seq(self):
+        return self._seq, int(1000 * self.clock()) & 0xFFFF
+
+    def on_send(self, seq):
+        now = self.clock()
+        with self._lock:
+            self._inflight[seq[0]] = (seq[1], now)
+            self._seq = (seq[0] + 1) & 0xFFFF
+            self.sent += 1
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._inflight:
+            seq, (_, sent) = next(iter(self._inflight.items()))
+            if now - sent < self.timeout:
+                break
+            del self._inflight[seq]
+            self.lost += 1
+
+    # returns True if the line was an ack
+    def on_line(self, line, now=None):
+        if not line.startswith('ACK '):
+            return False
+        now = self.clock() if now is None else now
+        try:
+            seq, stamp = (int(v) for v in line.split()[1:3])
+        except ValueError:
+            self.unmatched += 1
+            return True
+
+        with self._lock:
+            sent = self._inflight.get(seq)
+            if sent is None or sent[0] != stamp:
+                self.unmatched += 1
+                return True
+            del self._inflight[seq]
+            ms = 1000 * (now - sent[1])
+            self.bins[min(int(ms / BIN_MS), len(self.bins) - 1)] += 1
+            self.acked += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+        return True
+
+    def percentile(self, p):
+        target = p / 100 * self.acked
+        count = 0
+        for i, n in enumerate(self.bins):
+            count += n
+            if n and count >= target:
+                return min((i + 1) * BIN_MS, self.max_ms)
+        return 0.0
+
+    def coarse_histogram(self, edges=COARSE_EDGES):
+        counts = [0] * (len(edges) + 1)
+        k = 0
+        for i, n in enumerate(self.bins):
+            if not n:
+                continue
+            while k < len(edges) and i * BIN_MS >= edges[k]:
+                k += 1
+            counts[k] += n
+        return counts
+
+    def stats(self):
+        with self._lock:
+            self._expire(self.clock())
+            pending = len(self._inflight)
+        return {
+            'sent': self.sent,
+            'acked': self.acked,
+            'lost': self.lost,
+            'pending': pending,
+            'unmatched': self.unmatched,
+            'loss': self.lost / (self.acked + self.lost) if self.acked + self.lost else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'avg_ms': self.total_ms / self.acked if self.acked else 0.0,
+            'max_ms': self.max_ms,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"latency p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+                f"max {stats['max_ms']:.1f} ms, {stats['acked']} acked, {stats['lost']} lost ({100 * stats['loss']:.1f}%)")
+
+    def dump(self, path):
+        report = self.stats() | {
+            'bin_ms': BIN_MS,
+            'histogram': {f'{i * BIN_MS:g}': n for i, n in enumerate(self.bins) if n},
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,29 +1,92 @@
-import serial
+import os
+import sys
 import pygame
 import pygame.joystick as js
 import math
-from time import sleep
+from collections import OrderedDict
+from functools import partial
+from time import perf_counter
+
+from protocol import INTVALS, BOOLVALS, DeltaEncoder, encode_binary, encode_frame
+from curves import RAW_MIN, AxisCurves, stick_curve, trigger_curve
+from profiles import AXES_ORDER, AXIS_RANGE, BUTTONS_ORDER, KEYBOARD, PRO_CONTROLLER, PS5_CONTROLLER, find_profile
+from state import ControllerState
+from serial_link import PortPool
+from latency import COARSE_EDGES, LatencyTracker
+from telemetry import Telemetry
+from channels import OWNERSHIPS, ROLES, SINGLE, Route
+from scheduler import Scheduler
 
-pygame.init()
 FPS=20
+DEFAULT_RATES = {'input': 250, 'transmit': 100, 'render': 20}  # Hz, see Game(rates=...)
 WIDTH = 700
 HEIGHT = 1050
 
-INTVALS = 6
-BOOLVALS = 18
+# Brings up only what the loop needs instead of pygame.init(): the event queue (it
+# lives in the video subsystem, no window is opened) and joysticks, plus fonts for
+# GameVerbose. Without a display (ssh, a headless Pi) the dummy video driver still
+# delivers joystick events.
+def init_pygame(font=False):
+    if not pygame.display.get_init():
+        try:
+            pygame.display.init()
+        except pygame.error:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            pygame.display.init()
+    pygame.joystick.init()
+    if font:
+        pygame.font.init()
+
 
 # Class for printing text on the screen
+#
+# Rendered lines are kept in an LRU cache keyed by the text, and the printer remembers
+# what it last drew at every position. Printing the same text at the same place again
+# does nothing, changed lines are erased and redrawn and their rects collected for
+# flush(), so a frame where nothing changed costs a few dict lookups.
+# Lines printed between begin() and flush() are per frame: if one is not printed in
+# the next frame it is erased. Lines printed outside a frame (the joystick meta data)
+# stay until invalidate().
 
 
 class TextPrint:
-    def __init__(self):
+    def __init__(self, background=(255, 255, 255), cache_size=512):
         self.reset()
+        pygame.font.init()
         self.font = pygame.font.Font(None, 25)
+        self.background = background
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lines = {}         # (x, y) -> (text, rect) currently on screen
+        self.frame_lines = {}   # (x, y) -> rect of the lines printed in the last frame
+        self.printed = None     # positions printed in the current frame, None outside a frame
+        self.dirty = []
+
+    def render(self, text):
+        if (bitmap := self.cache.get(text)) is not None:
+            self.cache.move_to_end(text)
+            return bitmap
+        bitmap = self.cache[text] = self.font.render(text, True, (0, 0, 0))
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return bitmap
 
     def tprint(self, screen, text):
-        text_bitmap = self.font.render(text, True, (0, 0, 0))
-        screen.blit(text_bitmap, (self.x, self.y))
+        pos = (self.x, self.y)
         self.y += self.line_height
+        if self.printed is not None:
+            self.printed.add(pos)
+
+        if (line := self.lines.get(pos)) is not None and line[0] == text:
+            return
+        text_bitmap = self.render(text)
+        rect = text_bitmap.get_rect(topleft=pos)
+        if line is not None:
+            screen.fill(self.background, line[1])
+            rect = rect.union(line[1])
+        screen.blit(text_bitmap, pos)
+        self.lines[pos] = (text, text_bitmap.get_rect(topleft=pos))
+        self.dirty.append(rect)
 
         # debug
         # print(text)
@@ -43,21 +106,56 @@ class TextPrint:
     def unindent(self):
         self.x -= self.tab
 
+    def begin(self):
+        self.printed = set()
+
+    # erases the per frame lines that were not printed again, returns the rects to update
+    def flush(self, screen):
+        if self.printed is not None:
+            for pos in self.frame_lines.keys() - self.printed:
+                if (line := self.lines.pop(pos, None)) is not None:
+                    screen.fill(self.background, line[1])
+                    self.dirty.append(line[1])
+            self.frame_lines = dict.fromkeys(self.printed)
+            self.printed = None
+        dirty, self.dirty = self.dirty, []
+        return dirty
+
+    # the screen was redrawn from scratch, forget what is on it
+    def invalidate(self, rect):
+        self.lines.clear()
+        self.frame_lines.clear()
+        self.printed = None
+        self.dirty = [rect]
+
 # Base class for joystick controllers
 
 
 class Controller:
-    def __init__(self, controller, printer=None, applyOuterDeadZone=True, verbose=True):
+    def __init__(self, controller, printer=None, applyOuterDeadZone=True, verbose=True, protocol='text'):
 
         self.verbose = verbose
         self.controller = controller
         self.applyOuterDeadZone = applyOuterDeadZone
         self.printer = printer
+        self.protocol = protocol  # 'text', 'binary' or 'delta', see protocol.py
+        self.delta = DeltaEncoder() if protocol == 'delta' else None
         self.model_num = -1  # generic
         self.serial_cache = []  # dummy val
+        self.sent_version = -1
+        self.tracker = None  # LatencyTracker, frames get sequence numbers when set
+        self.tag = None  # TAG byte of binary frames, see Multiplexer
 
         if self.verbose:
             self.get_meta()
+            self.set_state(ControllerState(range(self.numaxes), range(self.numbuttons), self.numhats))
+
+    # axes / buttons / hats are dict like views of the state arrays, see state.py
+    def set_state(self, state):
+        self.state = state
+        self.axes = state.axes_view
+        self.buttons = state.buttons_view
+        self.hats = state.hats_view
 
     def get_meta(self):
         self.jid = self.controller.get_instance_id()
@@ -79,12 +177,31 @@ class Controller:
         printer.indent()
 
     def get_data(self):
-        self.axes = {i: int(100 * round(self.controller.get_axis(i),   2)) for i in range(self.numaxes)}
-        self.buttons = {i: int(round(self.controller.get_button(i), 2)) for i in range(self.numbuttons)}
-        self.hats = {i: int(100 * round(self.controller.get_hat(i),    2)) for i in range(self.numhats)}
+        state = self.state
+        get_axis = self.controller.get_axis
+        get_button = self.controller.get_button
+        for i in range(self.numaxes):
+            state.set_axis(i, int(100 * round(get_axis(i), 2)))
+        for i in range(self.numbuttons):
+            state.set_button(i, get_button(i))
+        for i in range(self.numhats):
+            state.set_hat(i, self.controller.get_hat(i))
+
+    # incremental updates from joystick events (Game input_mode='events')
+    def on_axis(self, axis, value):
+        self.state.set_axis(axis, int(100 * round(value, 2)))
+
+    def on_button(self, button, pressed):
+        self.state.set_button(button, int(pressed))
+
+    def on_hat(self, hat, value):
+        self.state.set_hat(hat, value)
 
     def print_data(self, screen, printer=None):
         self.get_data()
+        self.draw_data(screen, printer)
+
+    def draw_data(self, screen, printer=None):
         printer = self.printer if not printer else printer
 
         data_map = {
@@ -100,56 +217,160 @@ class Controller:
                 printer.tprint(screen, f'{key}: {val}')
             printer.unindent()
 
-    def send_serial(self, com='COM5', baud=9600):
-        if not self.serial_init:
-            self.ser = serial.Serial(com, baud, timeout=1)
-            self.serial_init = True
-            sleep(6)
-        intVals = list(self.axes.values()) + [0] * (INTVALS - len(self.axes.values()))
-        boolVals = list(self.buttons.values()) + [0] * (INTVALS - len(self.buttons.values()))
-
-        data = str([self.model_num] + intVals + boolVals)
-        #print(data)
-        if data != self.serial_cache:
-            self.ser.write(data.encode())
-            self.serial_cache = data
-    
-    def read_serial(self):
-        if (output := self.ser.read_all().decode()):
-                print(output)
+    # views into the state arrays, copy them (state.snapshot()) to keep them past this frame
+    def wire_values(self):
+        return self.state.wire_axes, self.state.wire_buttons
+
+    def encode(self):
+        intVals, boolVals = self.wire_values()
+        if self.delta is not None:
+            return self.delta.encode(self.model_num, intVals, boolVals, tag=self.tag)
+        return encode_frame(self.protocol, self.model_num, intVals, boolVals, self.tag)
+
+    # Frame to hand to a writer, None if nothing changed.
+    # Delta frames are returned as a callable so the writer encodes them right before
+    # the write, a snapshot dropped from the mailbox then never leaves the encoder ahead
+    # of the vehicle. A board that reset on reconnect has lost the last frame as well,
+    # the writer forces a keyframe for that (SerialWriter.on_connect).
+    # Sequenced frames are deferred the same way, only frames that go out use up a number.
+    def next_frame(self):
+        if self.tracker is not None and (self.delta is not None or self.state.version != self.sent_version):
+            self.sent_version = self.state.version
+            return partial(self.encode_sequenced, *self.state.snapshot())
+
+        if self.delta is not None:
+            return partial(self.delta.encode, self.model_num, *self.state.snapshot(), tag=self.tag)
+
+        if self.state.version == self.sent_version:
+            return None
+        self.sent_version = self.state.version
+
+        intVals, boolVals = self.wire_values()
+        data = encode_frame(self.protocol, self.model_num, intVals, boolVals, self.tag)
+        if data == self.serial_cache:
+            return None
+        self.serial_cache = data
+        return data
+
+    def encode_sequenced(self, intVals, boolVals):
+        seq = self.tracker.next_seq()
+        if self.delta is not None:
+            frame = self.delta.encode(self.model_num, intVals, boolVals, seq, self.tag)
+        else:
+            frame = encode_binary(self.model_num, intVals, boolVals, seq, self.tag)
+        if frame is not None:
+            self.tracker.on_send(seq)
+        return frame
+
+    # posts the frame to the port's writer thread, never blocks on the port
+    def send_serial(self, writer):
+        if (data := self.next_frame()) is not None:
+            #print(data)
+            writer.post(data)
 
     def debug(self):
 
-        intVals = list(self.axes.values()) + [0] * (INTVALS - len(self.axes.values()))
-        boolVals = list(self.buttons.values()) + [0] * (INTVALS - len(self.buttons.values()))
-
-        data = str([self.model_num] + intVals + boolVals)
+        data = self.encode()
         if data != self.serial_cache:
             self.serial_cache = data
             print(data)
 
 
-# class keyboard
-
-class Keyboard:
-    def __init__(self, printer=None,  verbose=True):
-        self.verbose = verbose
-        self.printer = printer
-        self.model_num = -1  # generic
-        self.serial_cache = []  # dummy val
+# Keyboard as a controller, Game(keyboard=True) or a profiles.KeyMap. Needs the
+# GameVerbose window, SDL only reports keys to a focused window.
+#
+# Every mapped key has a bit in `keys`, set and cleared from KEYDOWN / KEYUP, nothing
+# is read from pygame per tick and a tick without a key change or a moving axis does
+# no work. Axes ramp to the end their key asks for over `ramp_time` seconds (0 jumps),
+# so a key press behaves like pushing a stick. The frames go through the same
+# encoder / Multiplexer path as a pad's.
+
+KEYBOARD_JID = -1  # never a pygame instance id
+
+
+class Keyboard(Controller):
+    def __init__(self, keymap=KEYBOARD, printer=None, protocol='text', ramp_time=0.25, clock=perf_counter):
+        super().__init__(None, printer, verbose=False, protocol=protocol)
+        self.keymap = keymap
+        self.jid = KEYBOARD_JID
+        self.name = keymap.name
+        self.model_num = keymap.model_num
+        self.ramp_time = ramp_time
+        self.clock = clock
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
+
+        self.masks = {}  # pygame key code -> bit mask in keys
+        # (wire axis, low key mask, high key mask, low end, high end)
+        self.axis_keys = [
+            (AXES_ORDER.index(axis), self._mask(low), self._mask(high), *AXIS_RANGE[axis])
+            for axis, (low, high) in keymap.axes.items()
+        ]
+        self.button_keys = [(BUTTONS_ORDER.index(button), self._mask(key)) for button, key in keymap.buttons.items()]
+        self.trigger_buttons = [
+            (BUTTONS_ORDER.index(button), AXES_ORDER.index(axis), threshold)
+            for button, (axis, threshold) in keymap.trigger_buttons.items()
+        ]
+
+        self.keys = 0
+        self.applied_keys = 0  # keys the buttons / targets were last updated for
+        self.targets = [0] * INTVALS
+        self.moving = False
+        self.last_tick = None
+
+    def _mask(self, name):
+        if name is None:
+            return 0
+        code = pygame.key.key_code(name)
+        return self.masks.setdefault(code, 1 << len(self.masks))
+
+    def on_key(self, key, pressed):
+        if (mask := self.masks.get(key)) is None:
+            return
+        if pressed:
+            self.keys |= mask
+        else:
+            self.keys &= ~mask
+
+    # the window lost focus, its KEYUPs will never come
+    def release_all(self):
+        self.keys = 0
 
-        if self.verbose:
-            self.get_meta()
+    def get_data(self):
+        now = self.clock()
+        dt = now - self.last_tick if self.last_tick is not None else 0.0
+        self.last_tick = now
+        state = self.state
+
+        if (keys := self.keys) != self.applied_keys:
+            self.applied_keys = keys
+            for k, mask in self.button_keys:
+                state.set_button(k, int(keys & mask != 0))
+            for k, low, high, low_end, high_end in self.axis_keys:
+                towards_low, towards_high = keys & low != 0, keys & high != 0
+                self.targets[k] = high_end if towards_high and not towards_low else low_end if towards_low and not towards_high else 0
+            self.moving = True
+
+        if not self.moving:
+            return
+        moving = False
+        for k, low, high, low_end, high_end in self.axis_keys:
+            val, target = state.axes[k], self.targets[k]
+            if val == target:
+                continue
+            step = max(1, round(dt * max(-low_end, high_end) / self.ramp_time)) if self.ramp_time > 0 else abs(target - val)
+            val = min(val + step, target) if target > val else max(val - step, target)
+            state.set_axis(k, val)
+            moving = moving or val != target
+        self.moving = moving
+        for button, axis, threshold in self.trigger_buttons:
+            state.set_button(button, int(state.axes[axis] > threshold))
 
     def print_meta(self, screen, printer=None):
         printer = self.printer if not printer else printer
 
-        printer.tprint(screen, f"Keyboard")
+        printer.tprint(screen, f"Keyboard: {self.name}")
         printer.indent()
 
-    def get_data(self):
-        pressed_keys = pygame.key.get_pressed()
-
 
 # Controller subclass for Nintendo Switch Pro Controller
 
@@ -200,107 +421,253 @@ class Keyboard:
 #        self.axes['R_H'] *= -1
 
 
-class ProController(Controller):
-    def __init__(self, controller, printer=None, applyOuterDeadZone=True):
-        super().__init__(controller, printer, applyOuterDeadZone)
-        self.numbuttons = 16
-        self.model_num = 0  # switch pro controller
-        self.serial_init = False
-
-    def get_data(self):
-        super().get_data()
-        
-
-
-        buttonsMap = ['A', 'B', 'X', 'Y', 'Minus', 'Home', 'Plus', 'L_Stick', 'R_Stick', 'L', 'R', 'UP', 'DOWN', 'LEFT', 'RIGHT', 'Capture']
-        self.buttons = {buttonsMap[i]: v for i, v in enumerate(self.buttons.values())}
-        
-        axesMap = ['L_V', 'L_H', 'R_V', 'R_H', 'ZL', 'ZR']
-        self.axes = {axesMap[i]: v for i, v in enumerate(self.axes.values())}
-        
-        
-        
-        self.buttons['ZL'] = int((self.axes['ZL']) > 0)  # type: ignore
-        self.buttons['ZR'] = int((self.axes['ZR']) > 0)  # type: ignore
-
-        self.axes['ZL'] += 100
-        self.axes['ZR'] += 100
-        
-        self.buttons = {el: self.buttons[el] for el in [
-            'A', 'B', 'X', 'Y',
-            'UP', 'DOWN', 'LEFT', 'RIGHT',
-            'L', 'R', 'ZL', 'ZR', 'Plus',
-            'Minus', 'Home', 'Capture', 'L_Stick', 'R_Stick'
-        ]}
-
-        for key, val in self.axes.items():
-            if "Z" not in key:
-                if val in range(-10, 10):
-                    val = 0
-                if self.applyOuterDeadZone:
-                    mltp = 1.4  # 1 + (math.sin(math.pi/4) / 2) (mathimatically correct number, doesn't work because the controller is not perfect)                    if val > 0:
-                    val = 100 if (output := val*mltp) > 100 else round(output)
-                else:
-                    val = -100 if (output := val*mltp) < -100 else round(output)
-
-                val = 2 * round(val/2)  # clip val to nearest multiple of 5
-                self.axes[key] = val
-                    
-        
+# Gamepad driven by a profile (profiles.py), raw indices are read straight into wire order
 
-        self.axes = {el: self.axes[el] for el in ['L_H', 'L_V', 'R_H', 'R_V', 'ZL', 'ZR']}
-        self.axes['L_H'] *= -1
-        self.axes['R_H'] *= -1
-        
 
+class Gamepad(Controller):
+    def __init__(self, controller, profile, printer=None, applyOuterDeadZone=True, protocol='text', curve=None):
+        super().__init__(controller, printer, applyOuterDeadZone, protocol=protocol)
+        self.profile = profile
+        self.model_num = profile.model_num
+        self.plan = profile.compile(self.numaxes, self.numbuttons)
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
 
-class PS5Controller(Controller):
-    def __init__(self, controller, printer=None, applyOuterDeadZone=True):
-        super().__init__(controller, printer, applyOuterDeadZone)
-        self.numbuttons = 16
-        self.model_num = 1  # ps5 controller
-        self.serial_init = False
+        gain = profile.stick_gain if self.applyOuterDeadZone else 1.0
+        self.axis_curves = AxisCurves([
+            stick_curve(gain, curve, invert=True),  # L_H
+            stick_curve(gain, curve),               # L_V
+            stick_curve(gain, curve, invert=True),  # R_H
+            stick_curve(gain, curve),               # R_V
+            trigger_curve(),                        # ZL
+            trigger_curve(),                        # ZR
+        ])
+        self.axis_plan = list(zip(self.plan.axis_src, self.axis_curves.tables))
 
     def get_data(self):
-        super().get_data()
+        state = self.state
+        axes = state.axes
+        get_axis = self.controller.get_axis
+        get_button = self.controller.get_button
+
+        for k, (i, table) in enumerate(self.axis_plan):
+            state.set_axis(k, table[(int(100 * round(get_axis(i), 2)) if i >= 0 else 0) - RAW_MIN])
+        for k, i in enumerate(self.plan.button_src):
+            if i >= 0:
+                state.set_button(k, get_button(i))
+        for button, axis, threshold in self.plan.button_from_axis:
+            state.set_button(button, int(axes[axis] > threshold))
+
+    def on_axis(self, axis, value):
+        if (k := self.plan.axis_dst.get(axis)) is None:
+            return
+        state = self.state
+        state.set_axis(k, self.axis_curves.tables[k][int(100 * round(value, 2)) - RAW_MIN])
+        for button, a, threshold in self.plan.button_from_axis:
+            if a == k:
+                state.set_button(button, int(state.axes[k] > threshold))
+
+    def on_button(self, button, pressed):
+        if (k := self.plan.button_dst.get(button)) is not None:
+            self.state.set_button(k, int(pressed))
+
+    def on_hat(self, hat, value):
+        pass  # the d-pad is read as buttons
 
-        buttonsMap = ['B', 'A', 'Y', 'X', 'Minus', 'Home', 'Plus', 'L_Stick', 'R_Stick', 'L', 'R', 'UP', 'DOWN', 'LEFT', 'RIGHT', 'Capture']
-        self.buttons = {buttonsMap[i]: v for i, v in enumerate(self.buttons.values())}
 
-        axesMap = ['L_V', 'L_H', 'R_V', 'R_H', 'ZL', 'ZR']
-        self.axes = {axesMap[i]: v for i, v in enumerate(self.axes.values())}
-        
-        self.axes['ZL'] += 100
-        self.axes['ZR'] += 100
-        
-        self.buttons['ZL'] = int((self.axes['ZL']) > 100)  # type: ignore
-        self.buttons['ZR'] = int((self.axes['ZR']) > 100)  # type: ignore
+# Controller subclass for Nintendo Switch Pro Controller
 
-        self.buttons = {el: self.buttons[el] for el in [
-            'A', 'B', 'X', 'Y',
-            'UP', 'DOWN', 'LEFT', 'RIGHT',
-            'L', 'R', 'ZL', 'ZR', 'Plus',
-            'Minus', 'Home', 'Capture', 'L_Stick', 'R_Stick'
-        ]}
 
-        for key, val in self.axes.items():
-            if "Z" not in key:
-                if val in range(-10, 10):
-                    val = 0
-                if self.applyOuterDeadZone:
+class ProController(Gamepad):
+    def __init__(self, controller, printer=None, applyOuterDeadZone=True, protocol='text', curve=None):
+        super().__init__(controller, PRO_CONTROLLER, printer, applyOuterDeadZone, protocol, curve)
 
-                    mltp = 1.375  # ps5 better val
-                    if val > 0:
-                        val = 100 if (output := val*mltp) > 100 else round(output)
-                    else:
-                        val = -100 if (output := val*mltp) < -100 else round(output)
 
-                    val = 2 * round(val/2)  # clip val to nearest multiple of 5
-                    self.axes[key] = val
+class PS5Controller(Gamepad):
+    def __init__(self, controller, printer=None, applyOuterDeadZone=True, protocol='text', curve=None):
+        super().__init__(controller, PS5_CONTROLLER, printer, applyOuterDeadZone, protocol, curve)
 
-        self.axes = {el: self.axes[el] for el in ['L_H', 'L_V', 'R_H', 'R_V', 'ZL', 'ZR']}
-        self.axes['L_H'] *= -1
-        self.axes['R_H'] *= -1
+
+# Merges the connected controllers into the one frame sent per tick.
+#
+# Each controller is assigned a role and every wire channel is copied from the
+# controller whose role owns it (see channels.py). The merged state goes out through
+# the usual Controller.next_frame path, so there is one write per tick however many
+# controllers are connected. Binary frames are tagged with the roles present.
+
+
+class Multiplexer(Controller):
+    def __init__(self, ownership=SINGLE, protocol='text'):
+        super().__init__(None, verbose=False, protocol=protocol)
+        self.jid = 'mux'
+        self.ownership = ownership
+        self.plan = ownership.plan()
+        self.roles = [None] * len(ROLES)  # controller per role
+        self.sources = [None] * len(ROLES)  # controller each role's channels are read from
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
+
+    # gives the controller `role`, or the first free one, returns the role or None
+    def assign(self, controller, role=None):
+        r = ROLES.index(role) if role is not None else next((r for r, c in enumerate(self.roles) if c is None), None)
+        if r is None:
+            return None
+        self.roles[r] = controller
+        self._update()
+        return ROLES[r]
+
+    def release(self, controller):
+        self.roles = [None if c is controller else c for c in self.roles]
+        self._update()
+
+    def role_of(self, controller):
+        return next((ROLES[r] for r, c in enumerate(self.roles) if c is controller), None)
+
+    def _update(self):
+        present = [c for c in self.roles if c is not None]
+        self.sources = [c if c is not None else (present[0] if present else None) for c in self.roles]
+        self.model_num = present[0].model_num if present else -1
+        if self.protocol != 'text':
+            self.tag = sum(1 << r for r, c in enumerate(self.roles) if c is not None)
+        if self.delta is not None:
+            self.delta.force_keyframe()
+        self.state.version += 1
+
+    # copies the owned channels from each role's controller, False if there is none
+    def merge(self):
+        state = self.state
+        for r, axes, buttons in self.plan:
+            if (source := self.sources[r]) is None:
+                return False
+            for k in axes:
+                state.set_axis(k, source.state.axes[k])
+            for k in buttons:
+                state.set_button(k, source.state.buttons[k])
+        return True
+
+    def send_serial(self, writer):
+        if self.merge():
+            super().send_serial(writer)
+
+
+# Axis filtering after the merge (Game(filters=...), see filters.py).
+#
+# Holds the filtered frame: every tick the merged axes go through the filter, which
+# also runs when the input did not change so smoothing can settle, and the buttons are
+# copied. The version only moves when a filtered value does, so jitter the filter
+# holds back sends nothing. `suppressed` counts merged input changes that did not
+# change the frame.
+
+class FilterStage(Controller):
+    def __init__(self, axis_filter, protocol='text'):
+        super().__init__(None, verbose=False, protocol=protocol)
+        self.jid = 'filter'
+        self.filter = axis_filter
+        self.source_version = None
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
+
+        # counters
+        self.input_changes = 0
+        self.suppressed = 0
+
+    def update(self, frame):
+        self.model_num = frame.model_num
+        self.tag = frame.tag
+        source = frame.state
+        state = self.state
+        version = state.version
+        for k, val in enumerate(self.filter.apply(source.wire_axes)):
+            state.set_axis(k, val)
+        for k in range(BOOLVALS):
+            state.set_button(k, source.buttons[k])
+        if source.version != self.source_version:
+            self.source_version = source.version
+            self.input_changes += 1
+            if state.version == version:
+                self.suppressed += 1
+
+    def stats(self):
+        return self.filter.stats() | {'input_changes': self.input_changes, 'suppressed': self.suppressed}
+
+
+# Thruster mixing after the merge (Game(mixer=...), see mixer.py).
+#
+# Holds the frame that is actually sent: the mixer's motor powers in the wire axes,
+# the merged buttons unchanged. The mix only runs when the merged input changed.
+
+class MixerStage(Controller):
+    def __init__(self, mixer, protocol='text'):
+        super().__init__(None, verbose=False, protocol=protocol)
+        self.jid = 'mixer'
+        self.mixer = mixer
+        self.model_num = mixer.model_num
+        self.source_version = None
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
+
+    def update(self, frame):
+        self.tag = frame.tag
+        source = frame.state
+        if source.version == self.source_version:
+            return
+        self.source_version = source.version
+        state = self.state
+        for k, power in enumerate(self.mixer.mix(source.wire_axes)):
+            state.set_axis(k, power)
+        for k in range(BOOLVALS):
+            state.set_button(k, source.buttons[k])
+
+
+# The channels of the merged frame that go to one port (channels.Route).
+#
+# Each port gets its own frame state, delta encoder, latency tracker and telemetry,
+# channels not routed to it stay at rest. A port is only sent a frame when one of its
+# own channels changed, and the frame is posted to that port's writer thread.
+
+class RouteOutput(Controller):
+    def __init__(self, route, port, protocol='text', keyframe_interval=20, latency=False, telemetry=None):
+        super().__init__(None, verbose=False, protocol=protocol)
+        self.jid = route.com
+        self.route = route
+        self.port = port
+        self.routed_axes, self.routed_buttons = route.plan()
+        self.set_state(ControllerState(AXES_ORDER, BUTTONS_ORDER))
+        if self.delta is not None:
+            self.delta.keyframe_interval = keyframe_interval
+        self.tracker = LatencyTracker() if latency else None
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.connects = 0  # port.link.connects at the last send_serial
+
+    # copies the routed channels from the merged (or mixed) frame
+    def update(self, frame):
+        state = self.state
+        source = frame.state
+        self.model_num = frame.model_num
+        if self.tag != frame.tag:
+            self.tag = frame.tag
+            if self.delta is not None:
+                self.delta.force_keyframe()
+            state.version += 1
+        for k in self.routed_axes:
+            state.set_axis(k, source.axes[k])
+        for k in self.routed_buttons:
+            state.set_button(k, source.buttons[k])
+
+    # a board that reset on reconnect gets the current frame again, even if unchanged
+    def send_serial(self, writer):
+        if self.port.link.connects != self.connects:
+            self.connects = self.port.link.connects
+            self.sent_version = -1
+            self.serial_cache = []
+        super().send_serial(writer)
+
+    # called on the port's reader thread, unclaimed lines are printed
+    def handle_line(self, line, t):
+        acked = self.tracker is not None and self.tracker.on_line(line, t)
+        return self.telemetry.on_line(line, t) or acked
+
+    def stats(self):
+        stats = self.port.stats()
+        if self.tracker is not None:
+            stats |= {f'latency_{key}': value for key, value in self.tracker.stats().items()}
+        return stats
 
 
 def print_numjoys(screen, printer=None):
@@ -311,16 +678,178 @@ def print_numjoys(screen, printer=None):
 
 
 class Game:
-    def __init__(self, com='COM5', baud=9600, sendserial=True):
+    def __init__(self, com='COM5', baud=9600, sendserial=True, protocol='text', keyframe_interval=20, input_mode='poll', rates=None,
+                 latency=False, latency_dump=None, record=None, ownership=SINGLE, pool=None, routes=None, mixer=None, settle=6,
+                 keyboard=None, filters=None):
+        init_pygame()
         self.com = com
         self.baud = baud
+        self.settle = settle  # seconds to wait after opening a port (the arduino resets)
         self.sendserial = sendserial
+        self.protocol = protocol
+        self.keyframe_interval = keyframe_interval  # frames between full frames with protocol='delta'
+
+        # 'poll' reads every controller each frame and sleeps to FPS.
+        # 'events' updates controllers from joystick events and blocks on the event
+        # queue for at most event_timeout ms, frames go out as soon as input changes.
+        self.input_mode = input_mode
+        self.event_timeout = 1000 // FPS
+
+        # Separate input / transmit / render rates in Hz, run by a Scheduler, missing
+        # keys fall back to DEFAULT_RATES. None keeps the single loop paced by FPS.
+        self.rates = rates
+        self.scheduler = None
+
+        # Sequence numbers on every frame and the firmware's acks matched to them, see
+        # latency.py. Only binary frames have room for them. The stats are printed on
+        # close and written to latency_dump as json if given.
+        if latency and protocol == 'text':
+            raise ValueError("latency tracking needs protocol='binary' or 'delta'")
+        self.latency = latency
+        self.latency_dump = latency_dump
+        self.tracker = None
+        self.reader = None
+        self.telemetry = Telemetry()  # records the vehicle sends back, see telemetry.py
+
+        # path of a session log every change of the frame the ports get (merged, filtered
+        # and mixed) is appended to, see recorder.py
+        if record:
+            from recorder import Recorder
+            self.recorder = Recorder(record)
+        else:
+            self.recorder = None
+        self.recorded_version = None
+
+        # every controller goes into one frame per tick, ownership ('single', 'split' or
+        # a channels.Ownership) decides which controller drives which channel
+        if isinstance(ownership, str):
+            ownership = OWNERSHIPS[ownership]
+        self.mux = Multiplexer(ownership, protocol)
+        if self.mux.delta is not None:
+            self.mux.delta.keyframe_interval = self.keyframe_interval
+        self.pool = pool if pool is not None else PortPool()
+
+        # channels.Route per port for vehicles with several boards, the merged frame is
+        # split between them. None sends everything to com / baud.
+        self.routes = routes
+        self.outputs = []
+
+        # filters.AxisFilter on the merged axes against jitter, True for the defaults
+        if filters is True:
+            from filters import AxisFilter
+            filters = AxisFilter()
+        self.filter = FilterStage(filters, protocol) if filters else None
+
+        # mixer.Mixer turning the (filtered) axes into motor powers, None sends the axes
+        self.mixer = MixerStage(mixer, protocol) if mixer is not None else None
+
         self.joysticks = {}
+        # Keyboard controller, keyboard=True for profiles.KEYBOARD or a KeyMap
+        self.keyboard = None
+        if keyboard:
+            self.add_keyboard(KEYBOARD if keyboard is True else keyboard)
         self.clock = pygame.time.Clock()
         self.done = False
+        self.link = None
+        self.writer = None
+        self.link_states = {}
+
+        # time to first command: from `started` (cli.py sets the process start) to the
+        # first frame written to the first port, warned about past startup_budget_ms
+        # plus the port's settle time
+        self.started = perf_counter()
+        self.startup_budget_ms = None
+        self.first_command_ms = None
+
+        if self.sendserial:
+            self.open_link()
+
+    # open the ports in the background right away, the loop never waits on them
+    def open_link(self, settle=None):
+        settle = self.settle if settle is None else settle
+        max_rate = (DEFAULT_RATES | self.rates)['transmit'] if self.rates is not None else FPS
+        routes = self.routes or [Route(self.com, self.baud)]
+        if len({route.com for route in routes}) != len(routes):
+            raise ValueError('one route per port')
+        self.outputs = []
+        for route in routes:
+            # the first port's telemetry is self.telemetry
+            output = RouteOutput(route, None, self.protocol, self.keyframe_interval, self.latency,
+                                 None if self.outputs else self.telemetry)
+            output.port = self.pool.open(route.com, route.baud, output.handle_line, max_rate=max_rate, settle=settle)
+            if output.delta is not None:
+                output.port.writer.on_connect = output.delta.force_keyframe
+            self.outputs.append(output)
+
+        # the first port is the one shown when there is room for only one
+        primary = self.outputs[0].port
+        self.link = primary.link
+        self.writer = primary.writer
+        self.reader = primary.reader
+        self.tracker = self.outputs[0].tracker
+
+    # one merged frame for all controllers through the filter and the mixer, None
+    # without a controller. This is the frame the session log records.
+    def merge_frame(self):
+        if not self.mux.merge():
+            return None
+        frame = self.mux
+        if self.filter is not None:
+            self.filter.update(frame)
+            frame = self.filter
+        if self.mixer is not None:
+            self.mixer.update(frame)
+            frame = self.mixer
+        if self.recorder is not None and frame.state.version != self.recorded_version:
+            self.recorded_version = frame.state.version
+            self.recorder.record(frame.tag or 0, frame.model_num, frame.state.wire_axes, frame.state.wire_buttons)
+        return frame
+
+    # each port gets its channels of the merged frame
+    def send_serial(self):
+        if (frame := self.merge_frame()) is None:
+            return
+        for output in self.outputs:
+            output.update(frame)
+            output.send_serial(output.port.writer)
+
+    def read_serial(self):
+        if self.first_command_ms is None and self.writer.first_write is not None:
+            self.report_first_command()
+        for output in self.outputs:
+            port = output.port
+            if port.link.state != self.link_states.get(port.com):
+                self.link_states[port.com] = port.link.state
+                print(f"Serial {port.com}: {port.link.state}")
+            for line in port.reader.pop_lines():
+                print(line if len(self.outputs) == 1 else f"{port.com}: {line}")
+
+    def report_first_command(self):
+        self.first_command_ms = 1000 * (self.writer.first_write - self.started)
+        settled_ms = 1000 * self.link.settled  # network ports (transport.py) do not settle
+        print(f"First command {self.first_command_ms:.0f} ms after start ({settled_ms:.0f} ms of it settling the port)")
+        if self.startup_budget_ms is not None and self.first_command_ms - settled_ms > self.startup_budget_ms:
+            print(f"Startup over budget: {self.first_command_ms - settled_ms:.0f} ms > {self.startup_budget_ms} ms")
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        self.pool.close()
+        for k, output in enumerate(self.outputs):
+            if output.tracker is None:
+                continue
+            print(f"Serial {output.port.com}: {output.tracker.summary()}")
+            if self.latency_dump:
+                root, ext = os.path.splitext(self.latency_dump)
+                output.tracker.dump(self.latency_dump if k == 0 else f"{root}-{k}{ext}")
 
     def handle_events(self):
-        for event in pygame.event.get():
+        if self.input_mode == 'events' and self.event_timeout:
+            events = [pygame.event.wait(self.event_timeout)] + pygame.event.get()
+        else:
+            events = pygame.event.get()
+
+        for event in events:
             match event.type:
                 case pygame.QUIT:
                     self.done = True
@@ -328,57 +857,128 @@ class Game:
                     self.handle_joy_added(event)
                 case pygame.JOYDEVICEREMOVED:
                     self.handle_joy_removed(event)
+                case pygame.JOYAXISMOTION | pygame.JOYBUTTONDOWN | pygame.JOYBUTTONUP | pygame.JOYHATMOTION:
+                    if self.input_mode == 'events':
+                        self.handle_joy_input(event)
+                case pygame.KEYDOWN | pygame.KEYUP:
+                    if self.keyboard is not None:
+                        self.keyboard.on_key(event.key, event.type == pygame.KEYDOWN)
+                case pygame.WINDOWFOCUSLOST:
+                    if self.keyboard is not None:
+                        self.keyboard.release_all()
+
+    def handle_joy_input(self, event):
+        if (joy := self.joysticks.get(event.instance_id)) is None:
+            return
+        match event.type:
+            case pygame.JOYAXISMOTION:
+                joy.on_axis(event.axis, event.value)
+            case pygame.JOYBUTTONDOWN:
+                joy.on_button(event.button, True)
+            case pygame.JOYBUTTONUP:
+                joy.on_button(event.button, False)
+            case pygame.JOYHATMOTION:
+                joy.on_hat(event.hat, event.value)
 
     def handle_joy_added(self, event):
 
-        joy = js.Joystick(event.device_index).get_name()
-        match joy:
-            case 'Nintendo Switch Pro Controller':
-                joy = ProController(js.Joystick(event.device_index))
-            case 'PS5 Controller':
-                joy = PS5Controller(js.Joystick(event.device_index))
-            case _:
-                joy = Controller(js.Joystick(event.device_index))
+        joystick = js.Joystick(event.device_index)
+        if (profile := find_profile(joystick.get_name(), joystick.get_guid())) is not None:
+            joy = Gamepad(joystick, profile, protocol=self.protocol)
+        else:
+            joy = Controller(joystick, protocol=self.protocol)
+
+        joy.get_data()  # events only report changes, start from the current values
+        self.joysticks[joy.jid] = joy
+        role = self.mux.assign(joy)
+        print(f"Joystick {joy.jid} connected" + (f" as {role}" if role else ", no free role"))
+        return joy
 
+    def add_keyboard(self, keymap=KEYBOARD):
+        joy = self.keyboard = Keyboard(keymap, protocol=self.protocol)
         self.joysticks[joy.jid] = joy
-        print(f"Joystick {joy.jid} connected")
+        role = self.mux.assign(joy)
+        print("Keyboard connected" + (f" as {role}" if role else ", no free role"))
         return joy
 
     def handle_joy_removed(self, event):
 
-        del self.joysticks[event.instance_id]
+        self.mux.release(self.joysticks.pop(event.instance_id))
         print(f"Joystick {event.instance_id} disconnected")
 
     def main_loop(self):
 
         for joystick in self.joysticks.values():
-            joystick.get_data()
-            if self.sendserial:
-                joystick.send_serial(self.com, self.baud)
+            if self.input_mode == 'poll' or joystick is self.keyboard:
+                joystick.get_data()
         
         #joystick.debug()
         if self.sendserial:
-            if (output := joystick.ser.read_all().decode()):
-                    print(output) 
-        self.clock.tick(FPS)
+            self.send_serial()
+            self.read_serial()
+        elif self.recorder is not None:
+            self.merge_frame()
+        if self.input_mode == 'poll':
+            self.clock.tick(FPS)
         
 
 
     def start_loop(self):
+        if self.rates is not None:
+            self.run_scheduled()
+            return
         while not self.done:
             self.handle_events()
             self.main_loop()
+        self.close()
+
+    def input_task(self):
+        self.handle_events()
+        if self.input_mode == 'poll':
+            for joystick in self.joysticks.values():
+                joystick.get_data()
+        elif self.keyboard is not None:
+            self.keyboard.get_data()
+
+    def transmit_task(self):
+        self.send_serial()
+        self.read_serial()
+        # follow what the link can actually carry, the configured rate is the upper bound
+        self.scheduler.get('transmit').set_rate(max(output.port.writer.budget.rate for output in self.outputs))
+
+    def build_scheduler(self):
+        rates = DEFAULT_RATES | self.rates
+        scheduler = Scheduler()
+        scheduler.add('input', rates['input'], self.input_task)
+        if self.sendserial:
+            scheduler.add('transmit', rates['transmit'], self.transmit_task)
+        elif self.recorder is not None:
+            scheduler.add('transmit', rates['transmit'], self.merge_frame)
+        return scheduler
+
+    def run_scheduled(self):
+        self.event_timeout = 0  # the scheduler does the waiting
+        self.scheduler = self.build_scheduler()
+        self.scheduler.run(lambda: self.done)
+        self.close()
+        for name, stats in self.scheduler.stats().items():
+            print(f"{name}: {stats['runs']} runs at {stats['rate']} Hz, {stats['overruns']} overruns, "
+                  f"late avg {stats['late_ms_avg']:.2f} ms max {stats['late_ms_max']:.2f} ms, "
+                  f"run avg {stats['run_ms_avg']:.2f} ms max {stats['run_ms_max']:.2f} ms")
 
 
 class GameVerbose(Game):
-    def __init__(self, printer=None, com='COM5', baud=9600, sendserial=True):
-        super().__init__(com, baud, sendserial)
+    # takes the same arguments as Game after `printer`
+    def __init__(self, printer=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        init_pygame(font=True)
 
         self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
         self.screen.fill((255, 255, 255))
         pygame.display.set_caption("Joystick example")
 
         self.printer = TextPrint() if not printer else printer
+        self.printer.invalidate(self.screen.get_rect())
         self.print_numjoys()
         self.meta_printedx = self.printer.x
         self.meta_printedy = self.printer.y
@@ -392,6 +992,7 @@ class GameVerbose(Game):
 
         self.printer.reset()
         self.screen.fill((255, 255, 255))
+        self.printer.invalidate(self.screen.get_rect())
         print_numjoys(self.screen, self.printer)
         joy = super().handle_joy_added(event)
         joy.print_meta(self.screen, self.printer)
@@ -401,26 +1002,107 @@ class GameVerbose(Game):
     def main_loop(self):
         for joystick in self.joysticks.values():
             joystick.print_data(self.screen, self.printer)
-            if self.sendserial:
-                joystick.send_serial(self.com, self.baud)
         
         #joystick.debug()
         if self.sendserial:
-            if (output := joystick.ser.read_all().decode()):
-                    print(output)   
-        pygame.display.update()
-        self.clock.tick(FPS)
+            self.send_serial()
+            self.read_serial()
+        elif self.recorder is not None:
+            self.merge_frame()
+        if self.writer is not None:
+            self.print_writer_stats()
+        if self.tracker is not None:
+            self.print_latency_stats()
+        if self.filter is not None:
+            self.print_filter()
+        if self.mixer is not None:
+            self.print_mixer()
+        if self.writer is not None:
+            self.print_telemetry()
+        pygame.display.update(self.printer.flush(self.screen))
+        if self.input_mode == 'poll':
+            self.clock.tick(FPS)
+
+    def clear_data(self):
+        self.printer.reset()
+        self.printer.x += self.meta_printedx
+        self.printer.y += self.meta_printedy
+        self.printer.begin()
 
     def start_loop(self):
+        if self.rates is not None:
+            self.run_scheduled()
+            return
         while not self.done:
-            self.printer.reset()
-            self.printer.x += self.meta_printedx
-            self.printer.y += self.meta_printedy
-            self.screen.fill((255, 255, 255), [self.meta_printedx] + [self.meta_printedy] + [WIDTH, HEIGHT])
             self.handle_events()
+            self.clear_data()
             self.main_loop()
+        self.close()
+
+    def build_scheduler(self):
+        scheduler = super().build_scheduler()
+        scheduler.add('render', (DEFAULT_RATES | self.rates)['render'], self.render_task)
+        return scheduler
+
+    # only draws, input and serial run in their own tasks
+    def render_task(self):
+        self.clear_data()
+        for joystick in self.joysticks.values():
+            joystick.draw_data(self.screen, self.printer)
+        if self.writer is not None:
+            self.print_writer_stats()
+        if self.tracker is not None:
+            self.print_latency_stats()
+        if self.filter is not None:
+            self.print_filter()
+        if self.mixer is not None:
+            self.print_mixer()
+        if self.writer is not None:
+            self.print_telemetry()
+        for name, stats in self.scheduler.stats().items():
+            self.printer.tprint(self.screen, f"{name} {stats['rate']:.0f} Hz: overruns {stats['overruns']}, late avg {stats['late_ms_avg']:.2f} ms max {stats['late_ms_max']:.2f} ms")
+        pygame.display.update(self.printer.flush(self.screen))
+
+    def print_writer_stats(self):
+        for output in self.outputs:
+            stats = output.stats()
+            self.printer.tprint(self.screen, f"Serial {output.port.com}: {stats['state']}, reconnects {stats['reconnects']}")
+            self.printer.tprint(self.screen, f"Frames: written {stats['written']}, overwritten {stats['overwritten']}, errors {stats['errors']}")
+            self.printer.tprint(self.screen, f"Write ms: last {stats['write_ms_last']:.2f}, avg {stats['write_ms_avg']:.2f}, max {stats['write_ms_max']:.2f}")
+            self.printer.tprint(self.screen, f"Link {output.port.baud} baud: {stats['achieved_hz']:.1f} Hz sent, {stats['throughput_bps']:.0f} B/s, "
+                                             f"{stats['capacity_hz']:.1f} Hz capacity, {stats['queue_depth']} bytes queued")
+            if output.tracker is not None and len(self.outputs) > 1:
+                self.printer.tprint(self.screen, f"Latency p50 {stats['latency_p50_ms']:.1f} ms, p95 {stats['latency_p95_ms']:.1f} ms, lost {stats['latency_lost']}")
+
+    def print_filter(self):
+        stats = self.filter.stats()
+        self.printer.tprint(self.screen, f"Filter: suppressed {stats['suppressed']} of {stats['input_changes']} input changes, "
+                                         f"deadzone {' '.join(str(v) for v in stats['deadzone'])}")
+
+    def print_mixer(self):
+        stats = self.mixer.mixer.stats()
+        powers = ' '.join(str(v) for v in self.mixer.state.axes[:stats['motors']])
+        self.printer.tprint(self.screen, f"Motors: {powers} (saturated {stats['saturated']} of {stats['mixes']})")
+
+    def print_telemetry(self):
+        now = perf_counter()
+        for kind in ('ENC', 'PWR'):
+            if (record := self.telemetry.latest(kind)) is not None:
+                self.printer.tprint(self.screen, f"{kind} {' '.join(str(v) for v in record[1:])} ({now - record.t:.1f} s ago)")
+
+    def print_latency_stats(self):
+        stats = self.tracker.stats()
+        self.printer.tprint(self.screen, f"Latency p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
+        self.printer.tprint(self.screen, f"Acked {stats['acked']}, lost {stats['lost']} ({100 * stats['loss']:.1f}%), in flight {stats['pending']}")
+        counts = self.tracker.coarse_histogram()
+        peak = max(counts) or 1
+        self.printer.indent()
+        for low, high, n in zip((0,) + COARSE_EDGES, COARSE_EDGES + (None,), counts):
+            label = f"{low}-{high} ms" if high is not None else f"{low}+ ms"
+            self.printer.tprint(self.screen, f"{label:>10} {'#' * round(30 * n / peak):<30} {n}")
+        self.printer.unindent()
 
 
 if __name__ == "__main__":
-    Game(com='COM6', baud=57600, sendserial=1).start_loop()
-    pygame.quit()
\ No newline at end of file
+    from cli import main
+    sys.exit(main())
\ No newline at end of file
@@ -1,8 +1,8 @@
-import serial
 import pygame
 import pygame.joystick as js
 import math
-from time import sleep
+
+from serial_link import SerialConnection
 
 pygame.init()
 
@@ -103,16 +103,19 @@ class Controller:
 
     def send_serial(self, com='COM5'):
         if not self.serial_init:
-            self.ser = serial.Serial(com, 74880, timeout=1)
+            # opens in the background, frames are skipped until the port is up
+            self.ser = SerialConnection(com, 74880, settle=3).start()
             self.serial_init = True
-            sleep(3)
 
         intVals = list(self.axes.values()) + [0] * (INTVALS - len(self.axes.values()))
         boolVals = list(self.buttons.values()) + [0] * (INTVALS - len(self.buttons.values()))
 
         data = str([self.model_num] + intVals + boolVals)
-        if data != self.serial_cache:
-            self.ser.write(data.encode())
+        if data != self.serial_cache and self.ser.is_up:
+            try:
+                self.ser.write(data.encode())
+            except OSError:
+                return
             self.serial_cache = data
             if (output := self.ser.read_all().decode()):
                 print(output)
@@ -0,0 +1,114 @@
+import json
+
+import numpy as np
+
+from protocol import INTVALS, MODEL_MIXED
+from profiles import AXES_ORDER
+
+# Thruster mixing on the topside: Game(mixer=Mixer(...)), needs numpy.
+#
+# The merged wire axes are turned into a 6-DOF command (surge, sway, heave, roll,
+# pitch, yaw, each -1..1) by the `inputs` gains, and the command into one power per
+# motor by the N x 6 allocation matrix, in two matrix-vector products. If a motor
+# would go past max_power all powers are scaled down together, so the thrust keeps
+# its direction. The powers replace the axes of the frame (motor k in wire axis k)
+# and the frame is sent as model MODEL_MIXED, HiTechnic.ino passes them straight to
+# move_power. The buttons are sent unchanged.
+#
+# A new frame geometry is a new allocation matrix, see the presets below or load().
+
+DOFS = ('surge', 'sway', 'heave', 'roll', 'pitch', 'yaw')
+
+
+# wire value of full deflection per axis, shaped sticks are -100..100, triggers 0..200
+FULL_SCALE = {'L_H': 100, 'L_V': 100, 'R_H': 100, 'R_V': 100, 'ZL': 200, 'ZR': 200}
+
+# gains from the wire axes to each DOF, full deflection is 1
+DEFAULT_INPUTS = {
+    'surge': {'L_V': 1},
+    'sway': {'L_H': 1},
+    'heave': {'R_V': 1},
+    'pitch': {'ZR': 1, 'ZL': -1},
+    'yaw': {'R_H': 1},
+}
+
+# what useParsedData does without a mixer: motor 1..4 follow L_H, L_V, R_H, R_V
+DIRECT_4 = [
+    # surge sway heave roll pitch yaw
+    [0, 1, 0, 0, 0, 0],
+    [1, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 1],
+    [0, 0, 1, 0, 0, 0],
+]
+
+# two horizontal thrusters steering by differential thrust, two vertical ones rolling
+# the same way (Driver1: left / right horizontal, Driver2: left / right vertical)
+DIFFERENTIAL_4 = [
+    [1, 0, 0, 0, 0, 1],
+    [1, 0, 0, 0, 0, -1],
+    [0, 0, 1, 1, 0, 0],
+    [0, 0, 1, -1, 0, 0],
+]
+
+
+# (len(DOFS), INTVALS) matrix from {dof: {axis: gain}}
+def input_matrix(inputs):
+    matrix = np.zeros((len(DOFS), INTVALS))
+    for dof, gains in inputs.items():
+        if dof not in DOFS:
+            raise ValueError(f'Unknown DOF: {dof!r}')
+        for axis, gain in gains.items():
+            if axis not in AXES_ORDER:
+                raise ValueError(f'Unknown axis: {axis!r}')
+            matrix[DOFS.index(dof), AXES_ORDER.index(axis)] = gain / FULL_SCALE[axis]
+    return matrix
+
+
+class Mixer:
+    model_num = MODEL_MIXED
+
+    def __init__(self, allocation, inputs=DEFAULT_INPUTS, max_power=100):
+        self.allocation = np.array(allocation, dtype=float)
+        if self.allocation.ndim != 2 or self.allocation.shape[1] != len(DOFS):
+            raise ValueError(f'allocation must be N x {len(DOFS)}, got {self.allocation.shape}')
+        self.motors = self.allocation.shape[0]
+        if not 0 < self.motors <= INTVALS:
+            raise ValueError(f'1 to {INTVALS} motors fit in a frame, got {self.motors}')
+        self.inputs = input_matrix(inputs)
+        self.max_power = max_power
+        self.gains = self.allocation * max_power
+        # wire axes straight to motor powers (N x INTVALS), both steps in one product
+        self.matrix = self.gains @ self.inputs
+
+        # reused by every mix()
+        self.power = np.zeros(self.motors)
+
+        # counters
+        self.mixes = 0
+        self.saturated = 0  # mixes that had to be scaled down
+
+    # motor powers (ints, -max_power..max_power) for the wire axes
+    def mix(self, axes):
+        np.matmul(self.matrix, np.asarray(axes, dtype=float), out=self.power)
+        peak = np.abs(self.power).max()
+        if peak > self.max_power:
+            self.power *= self.max_power / peak
+            self.saturated += 1
+        self.mixes += 1
+        return np.rint(self.power).astype(int).tolist()
+
+    def stats(self):
+        return {
+            'motors': self.motors,
+            'mixes': self.mixes,
+            'saturated': self.saturated,
+        }
+
+
+# Mixer from a json file:
+#   {"allocation": [[1, 0, 0, 0, 0, 1], ...], "inputs": {"surge": {"L_V": 1}, ...}, "max_power": 100}
+# inputs and max_power are optional
+def load(path):
+    with open(path) as f:
+        config = json.load(f)
+    return Mixer(config['allocation'], config.get('inputs', DEFAULT_INPUTS), config.get('max_power', 100))
@@ -0,0 +1,279 @@
+import os
+import gc
+import sys
+import struct
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from time import perf_counter
+
+from protocol import INTVALS, BOOLVALS
+
+# Input, control and UI in separate processes: python cli.py --engine processes
+#
+#   sampler  (this process)  reads the controllers at the input rate, merges them
+#                            (main.Multiplexer) and publishes the frame to FRAME
+#   control                  reads FRAME at its own fixed rate and writes the ports,
+#                            the normal Game send path (routes, mixer, latency)
+#   ui                       draws FRAME and the control process' STATS, it never
+#                            touches the controllers or the ports
+#
+# A slow render, a window event or a GC pause in one process cannot delay the
+# others, the control loop only ever waits on its own deadlines.
+#
+# The blocks live in multiprocessing.shared_memory and are guarded by a seqlock: the
+# one writer makes the sequence odd, writes, makes it even again. A reader copies the
+# block and keeps it only if the sequence was even and unchanged around the copy, so
+# nobody ever blocks on a lock held by another process.
+
+SEQ = struct.Struct('<I')
+PAYLOAD_OFFSET = 8  # keeps the payload 8 byte aligned
+
+# published frame: version, time (perf_counter, the same clock in every process on
+# one machine), model, tag (-1 none), connected (0 if there is no controller), wire values
+FRAME = f'<Idbhb{INTVALS}h{BOOLVALS}B'
+
+# control process counters for the ui, summed over the ports
+STATS_FIELDS = (
+    'ports', 'ports_up', 'written', 'overwritten', 'errors', 'achieved_hz', 'write_ms_max',
+    'input_age_ms', 'runs', 'overruns', 'late_ms_max', 'torn_reads', 'latency_p50_ms', 'latency_p95_ms',
+)
+STATS = '<' + 'd' * len(STATS_FIELDS)
+
+
+class SeqlockBlock:
+    def __init__(self, fmt, name=None, spins=1000):
+        self.layout = struct.Struct(fmt)
+        self.spins = spins
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=PAYLOAD_OFFSET + self.layout.size)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.buf = self.shm.buf
+        self.torn = 0  # reads retried because the writer was in the middle of a write
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, *values):
+        seq = SEQ.unpack_from(self.buf, 0)[0]
+        SEQ.pack_into(self.buf, 0, (seq + 1) & 0xFFFFFFFF)
+        self.layout.pack_into(self.buf, PAYLOAD_OFFSET, *values)
+        SEQ.pack_into(self.buf, 0, (seq + 2) & 0xFFFFFFFF)
+
+    # the last complete write, None if the writer did not finish one within `spins` tries
+    def read(self):
+        for _ in range(self.spins):
+            before = SEQ.unpack_from(self.buf, 0)[0]
+            if before & 1:
+                self.torn += 1
+                continue
+            values = self.layout.unpack_from(self.buf, PAYLOAD_OFFSET)
+            if SEQ.unpack_from(self.buf, 0)[0] == before:
+                return values
+            self.torn += 1
+        return None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Stands in for main.Multiplexer in the control process: merge() copies the published
+# frame into `state`, so Game.send_serial and everything after it work unchanged.
+
+class SharedFrameReader:
+    def __init__(self, block):
+        from state import ControllerState
+        from profiles import AXES_ORDER, BUTTONS_ORDER
+
+        self.block = block
+        self.state = ControllerState(AXES_ORDER, BUTTONS_ORDER)
+        self.model_num = -1
+        self.tag = None
+        self.stamp = None
+
+    def merge(self):
+        if (values := self.block.read()) is None:
+            return False
+        version, stamp, model_num, tag, connected = values[:5]
+        if not version or not connected:
+            return False
+        self.stamp = stamp
+        self.model_num = model_num
+        self.tag = tag if tag >= 0 else None
+        state = self.state
+        for k, val in enumerate(values[5:5 + INTVALS]):
+            state.set_axis(k, val)
+        for k, val in enumerate(values[5 + INTVALS:]):
+            state.set_button(k, val)
+        return True
+
+
+# sendserial=False opens no port, the frames are only merged, filtered, mixed and recorded
+def control_main(frame_name, stats_name, done, rate, game_kwargs, sendserial=True):
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    from main import Game
+    from scheduler import Scheduler
+
+    frame = SeqlockBlock(FRAME, frame_name)
+    stats = SeqlockBlock(STATS, stats_name)
+    game = Game(**game_kwargs, sendserial=sendserial)
+    game.mux = SharedFrameReader(frame)
+    scheduler = Scheduler()
+
+    def publish():
+        ports = [output.stats() for output in game.outputs]
+        tracker = game.tracker.stats() if game.tracker is not None else {}
+        age = 1000 * (perf_counter() - game.mux.stamp) if game.mux.stamp is not None else 0.0
+        task_stats = scheduler.get('transmit').stats()
+        stats.write(
+            len(ports), sum(p['state'] == 'up' for p in ports),
+            sum(p['written'] for p in ports), sum(p['overwritten'] for p in ports), sum(p['errors'] for p in ports),
+            sum(p['achieved_hz'] for p in ports), max(p['write_ms_max'] for p in ports),
+            age, task_stats['runs'], task_stats['overruns'], task_stats['late_ms_max'], frame.torn,
+            tracker.get('p50_ms', 0.0), tracker.get('p95_ms', 0.0),
+        )
+
+    def transmit():
+        game.send_serial()
+        game.read_serial()
+        publish()
+
+    scheduler.add('transmit', rate, transmit if sendserial else game.merge_frame)
+    # everything built so far lives until exit, keep the collector from rescanning it
+    gc.collect()
+    gc.freeze()
+    try:
+        scheduler.run(done.is_set)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        done.set()
+        game.close()
+        frame.close()
+        stats.close()
+
+
+def ui_main(frame_name, stats_name, done, rate):
+    import pygame
+    from main import TextPrint, WIDTH, HEIGHT, init_pygame
+    from profiles import AXES_ORDER, BUTTONS_ORDER
+
+    init_pygame(font=True)
+    frame = SeqlockBlock(FRAME, frame_name)
+    stats = SeqlockBlock(STATS, stats_name)
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    screen.fill((255, 255, 255))
+    pygame.display.set_caption("Joystick example")
+    printer = TextPrint()
+    printer.invalidate(screen.get_rect())
+    clock = pygame.time.Clock()
+    try:
+        while not done.is_set():
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    done.set()
+
+            printer.reset()
+            printer.begin()
+            if (values := frame.read()) is not None:
+                version, stamp, model_num, tag, connected = values[:5]
+                printer.tprint(screen, f"Frame {version}: model {model_num}, " + ("connected" if connected else "no controller"))
+                printer.indent()
+                for name, val in zip(AXES_ORDER, values[5:5 + INTVALS]):
+                    printer.tprint(screen, f"{name}: {val}")
+                for name, val in zip(BUTTONS_ORDER, values[5 + INTVALS:]):
+                    printer.tprint(screen, f"{name}: {val}")
+                printer.unindent()
+            if (values := stats.read()) is not None:
+                s = dict(zip(STATS_FIELDS, values))
+                printer.tprint(screen, f"Ports up {s['ports_up']:.0f} of {s['ports']:.0f}: written {s['written']:.0f}, "
+                                       f"overwritten {s['overwritten']:.0f}, errors {s['errors']:.0f}")
+                printer.tprint(screen, f"Sent {s['achieved_hz']:.1f} Hz, write ms max {s['write_ms_max']:.2f}, input age {s['input_age_ms']:.1f} ms")
+                printer.tprint(screen, f"Control: {s['runs']:.0f} runs, {s['overruns']:.0f} overruns, late max {s['late_ms_max']:.2f} ms, "
+                                       f"torn reads {s['torn_reads']:.0f}")
+                if s['latency_p50_ms']:
+                    printer.tprint(screen, f"Latency p50 {s['latency_p50_ms']:.1f} ms, p95 {s['latency_p95_ms']:.1f} ms")
+            pygame.display.update(printer.flush(screen))
+            clock.tick(rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        done.set()
+        frame.close()
+        stats.close()
+        pygame.quit()
+
+
+# Runs the sampler here and the control / ui processes next to it until the window is
+# closed or Ctrl+C. game_kwargs go to main.Game (com, baud, protocol, routes, mixer,
+# latency, record, ownership, ...), the sampler uses the input side of them and the
+# control process records the session log. With sendserial=False the control process
+# only runs to record, and opens no port.
+def run(rates=None, ui=True, sendserial=True, **game_kwargs):
+    from main import Game, DEFAULT_RATES
+    from scheduler import Scheduler
+
+    rates = DEFAULT_RATES | (rates or {})
+    ctx = mp.get_context('spawn')  # children start without the parent's SDL state
+    done = ctx.Event()
+    frame = SeqlockBlock(FRAME)
+    stats = SeqlockBlock(STATS)
+    frame.write(0, 0.0, -1, -1, 0, *[0] * (INTVALS + BOOLVALS))
+    stats.write(*[0.0] * len(STATS_FIELDS))
+
+    control_kwargs = {key: value for key, value in game_kwargs.items() if key not in ('ownership', 'input_mode')}
+    control_kwargs['rates'] = rates  # the writers' max rate follows rates['transmit']
+    processes = []
+    if sendserial or game_kwargs.get('record'):
+        processes.append(ctx.Process(target=control_main, name='control',
+                                     args=(frame.name, stats.name, done, rates['transmit'], control_kwargs, sendserial)))
+    if ui:
+        processes.append(ctx.Process(target=ui_main, name='ui', args=(frame.name, stats.name, done, rates['render'])))
+    for process in processes:
+        process.start()
+
+    sampler_kwargs = {key: value for key, value in game_kwargs.items() if key in ('protocol', 'ownership', 'input_mode')}
+    game = Game(sendserial=False, **sampler_kwargs)
+    game.event_timeout = 0
+    published = None
+
+    def sample():
+        game.input_task()
+        mux = game.mux
+        connected = mux.merge()
+        if (connected, mux.state.version) == published:
+            return
+        publish(connected)
+
+    def publish(connected):
+        nonlocal published
+        mux = game.mux
+        published = (connected, mux.state.version)
+        tag = mux.tag if mux.tag is not None else -1
+        frame.write(mux.state.version % 0xFFFFFFFF + 1, perf_counter(), mux.model_num, tag, int(connected),
+                    *mux.state.wire_axes, *mux.state.wire_buttons)
+
+    scheduler = Scheduler()
+    scheduler.add('input', rates['input'], sample)
+    try:
+        scheduler.run(lambda: game.done or done.is_set())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        done.set()
+        for process in processes:
+            process.join(5)
+        game.close()
+        frame.close()
+        stats.close()
+
+
+if __name__ == "__main__":
+    from cli import main
+    sys.exit(main(['--engine', 'processes'] + sys.argv[1:]))
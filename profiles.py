@@ -0,0 +1,148 @@
+from fnmatch import fnmatch
+
+# Controller profiles.
+#
+# A profile says which raw pygame axis / button index feeds which wire slot. It is
+# compiled once per connected controller into an IndexPlan, get_data then reads the
+# raw indices straight into wire order. Adding a gamepad is a new entry in PROFILES.
+
+# wire order of the named gamepad axes and buttons
+AXES_ORDER = ['L_H', 'L_V', 'R_H', 'R_V', 'ZL', 'ZR']
+BUTTONS_ORDER = [
+    'A', 'B', 'X', 'Y',
+    'UP', 'DOWN', 'LEFT', 'RIGHT',
+    'L', 'R', 'ZL', 'ZR', 'Plus',
+    'Minus', 'Home', 'Capture', 'L_Stick', 'R_Stick'
+]
+
+
+# vendor / product ids from an SDL2 joystick GUID string, None for non usb devices
+def usb_ids(guid):
+    if not guid or len(guid) < 20:
+        return None
+    try:
+        vendor = int(guid[10:12] + guid[8:10], 16)
+        product = int(guid[18:20] + guid[16:18], 16)
+    except ValueError:
+        return None
+    return (vendor, product) if vendor else None
+
+
+class IndexPlan:
+    def __init__(self, axis_src, button_src, button_from_axis):
+        self.axis_src = axis_src                # raw axis index per wire axis, -1 if missing
+        self.button_src = button_src            # raw button index per wire button, -1 if missing / derived
+        self.button_from_axis = button_from_axis  # (wire button, wire axis, threshold) for analog triggers
+
+        # reverse maps for event driven input, raw index -> wire slot
+        self.axis_dst = {raw: k for k, raw in enumerate(axis_src) if raw >= 0}
+        self.button_dst = {raw: k for k, raw in enumerate(button_src) if raw >= 0}
+
+
+class ControllerProfile:
+    def __init__(self, name, model_num, axes, buttons, names=(), ids=(), stick_gain=1.0, trigger_buttons=None):
+        self.name = name
+        self.model_num = model_num
+        self.axes = axes                # wire axis name for each raw axis index
+        self.buttons = buttons          # wire button name for each raw button index
+        self.names = names              # fnmatch patterns on the joystick name
+        self.ids = ids                  # (vendor, product) usb ids
+        self.stick_gain = stick_gain
+        self.trigger_buttons = trigger_buttons or {}  # wire button -> (wire axis, threshold)
+        self._plans = {}
+
+    def matches(self, name, guid=None):
+        if guid is not None and usb_ids(guid) in self.ids:
+            return True
+        return any(fnmatch(name, pattern) for pattern in self.names)
+
+    def compile(self, numaxes, numbuttons):
+        if (key := (numaxes, numbuttons)) in self._plans:
+            return self._plans[key]
+
+        raw_axis = {name: i for i, name in enumerate(self.axes) if i < numaxes}
+        raw_button = {name: i for i, name in enumerate(self.buttons) if i < numbuttons}
+
+        axis_src = [raw_axis.get(name, -1) for name in AXES_ORDER]
+        button_src = [raw_button.get(name, -1) for name in BUTTONS_ORDER]
+        button_from_axis = [
+            (BUTTONS_ORDER.index(button), AXES_ORDER.index(axis), threshold)
+            for button, (axis, threshold) in self.trigger_buttons.items()
+        ]
+
+        plan = self._plans[key] = IndexPlan(axis_src, button_src, button_from_axis)
+        return plan
+
+
+# ZL/ZR are analog on both pads and also sent as buttons, pressed past the rest position
+# (shaped trigger values are 0..200)
+TRIGGER_BUTTONS = {'ZL': ('ZL', 100), 'ZR': ('ZR', 100)}
+
+PRO_CONTROLLER = ControllerProfile(
+    'Nintendo Switch Pro Controller',
+    model_num=0,
+    axes=['L_V', 'L_H', 'R_V', 'R_H', 'ZL', 'ZR'],
+    buttons=['A', 'B', 'X', 'Y', 'Minus', 'Home', 'Plus', 'L_Stick', 'R_Stick', 'L', 'R', 'UP', 'DOWN', 'LEFT', 'RIGHT', 'Capture'],
+    names=['Nintendo Switch Pro Controller'],
+    ids=[(0x057E, 0x2009)],
+    stick_gain=1.4,  # 1 + (math.sin(math.pi/4) / 2) (mathimatically correct number, doesn't work because the controller is not perfect)
+    trigger_buttons=TRIGGER_BUTTONS,
+)
+
+PS5_CONTROLLER = ControllerProfile(
+    'PS5 Controller',
+    model_num=1,
+    axes=['L_V', 'L_H', 'R_V', 'R_H', 'ZL', 'ZR'],
+    buttons=['B', 'A', 'Y', 'X', 'Minus', 'Home', 'Plus', 'L_Stick', 'R_Stick', 'L', 'R', 'UP', 'DOWN', 'LEFT', 'RIGHT', 'Capture'],
+    names=['PS5 Controller', '*DualSense*'],
+    ids=[(0x054C, 0x0CE6), (0x054C, 0x0DF2)],
+    stick_gain=1.375,  # ps5 better val
+    trigger_buttons=TRIGGER_BUTTONS,
+)
+
+PROFILES = [PRO_CONTROLLER, PS5_CONTROLLER]
+
+
+def register(profile):
+    PROFILES.insert(0, profile)
+
+
+def find_profile(name, guid=None):
+    for profile in PROFILES:
+        if profile.matches(name, guid):
+            return profile
+    return None
+
+
+# wire range of each shaped axis, sticks rest in the middle, triggers at the bottom
+AXIS_RANGE = {'L_H': (-100, 100), 'L_V': (-100, 100), 'R_H': (-100, 100), 'R_V': (-100, 100), 'ZL': (0, 200), 'ZR': (0, 200)}
+
+
+# Keyboard layout for main.Keyboard, keys are pygame key names (pygame.key.name()).
+# An axis takes (key towards the low end, key towards the high end) of AXIS_RANGE, with
+# the signs a pad sends, either can be None. Trigger buttons follow their axis like
+# on the pads. model_num is the Switch Pro layout, the one HiTechnic.ino parses.
+
+class KeyMap:
+    def __init__(self, name, axes, buttons, model_num=0, trigger_buttons=None):
+        self.name = name
+        self.axes = axes                # wire axis -> (low key, high key)
+        self.buttons = buttons          # wire button -> key
+        self.model_num = model_num
+        self.trigger_buttons = trigger_buttons or {}  # wire button -> (wire axis, threshold)
+
+
+KEYBOARD = KeyMap(
+    'Keyboard',
+    axes={
+        'L_H': ('d', 'a'), 'L_V': ('w', 's'),
+        'R_H': ('right', 'left'), 'R_V': ('up', 'down'),
+        'ZL': (None, 'q'), 'ZR': (None, 'e'),
+    },
+    buttons={
+        'A': 'z', 'B': 'x', 'X': 'c', 'Y': 'v',
+        'UP': 'i', 'DOWN': 'k', 'LEFT': 'j', 'RIGHT': 'l',
+        'L': 'u', 'R': 'o', 'Plus': 'return', 'Minus': 'backspace',
+    },
+    trigger_buttons=TRIGGER_BUTTONS,
+)
@@ -0,0 +1,325 @@
+import struct
+
+# Wire layout shared by every frame format: model number, INTVALS axes, BOOLVALS buttons
+
+INTVALS = 6
+BOOLVALS = 18
+
+# Binary frame:
+#   [SYNC] [LEN] [MODEL] [FLAGS] [axes ...] [buttons ...] [CRC]
+#
+#   SYNC     0xA5
+#   LEN      number of bytes from MODEL up to (not including) CRC
+#   MODEL    int8 model number (-1 generic, 0 switch pro, 1 ps5)
+#   FLAGS    bit 0 set -> axes are int8, otherwise int16 little endian
+#            bit 1 set -> delta frame, see below
+#            bit 2 set -> SEQ and STAMP follow FLAGS, see below
+#            bit 3 set -> a TAG byte follows (after SEQ / STAMP), see below
+#   axes     INTVALS values
+#   buttons  BOOLVALS bits, LSB first
+#   CRC      crc8 (poly 0x07) over LEN .. last button byte
+#
+# The triggers (axes 4 and 5, shaped 0..200) are sent centered, minus TRIGGER_CENTER,
+# so they fit an int8 like the sticks and a steady state frame is 14 bytes (15 with the
+# TAG byte every frame main.Game sends has) whether they are pressed or not. Frames of motor powers (MODEL_MIXED, see mixer.py) are already
+# centered and sent as they are. The firmware only reads axes 0..3.
+#
+# Delta frames put a uint16 MASK after FLAGS and only carry the fields that changed
+# since the previous frame: bit i (0..5) -> axis i, bit 8 + g -> button byte g.
+# A receiver ignores deltas until it has seen a full frame (keyframe).
+#
+# Sequenced frames put a uint16 SEQ and a uint16 STAMP (sender clock in ms, wrapping)
+# right after FLAGS, before the delta MASK. The firmware answers every sequenced frame
+# it acted on with an "ACK <seq> <stamp>" line, see latency.py.
+#
+# Frames merged from several controllers (main.Multiplexer) carry a TAG byte before
+# the delta MASK, bit r is set when the controller of role r (0 pilot, 1 copilot,
+# see channels.py) is connected.
+
+SYNC = 0xA5
+FLAG_AXES8 = 0x01
+FLAG_DELTA = 0x02
+FLAG_SEQ = 0x04
+FLAG_TAGGED = 0x08
+
+MODEL_MIXED = 2  # frames carrying motor powers (mixer.py, modelMixed in HiTechnic.ino)
+TRIGGER_CENTER = 100
+TRIGGER_OFFSETS = (0, 0, 0, 0, TRIGGER_CENTER, TRIGGER_CENTER)
+NO_OFFSETS = (0,) * INTVALS
+
+BUTTON_BYTES = (BOOLVALS + 7) // 8
+FULL_MASK = (1 << INTVALS) - 1 | ((1 << BUTTON_BYTES) - 1) << 8
+MAX_BINARY_LEN = 9 + 2 * INTVALS + BUTTON_BYTES
+
+
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, crc=0):
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def pack_buttons(boolVals):
+    bits = 0
+    for i, v in enumerate(boolVals):
+        if v:
+            bits |= 1 << i
+    return bits.to_bytes(BUTTON_BYTES, 'little')
+
+
+def unpack_buttons(data):
+    bits = int.from_bytes(data, 'little')
+    return [(bits >> i) & 1 for i in range(BOOLVALS)]
+
+
+# Text frame, the original "[model, ints..., bools...]" format parsed by HiTechnic.ino
+
+def encode_text(model_num, intVals, boolVals):
+    return str([model_num] + list(intVals) + list(boolVals)).encode()
+
+
+def decode_text(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+    vals = [int(v) for v in data.strip().strip('[]').split(',')]
+    return vals[0], vals[1:1 + INTVALS], vals[1 + INTVALS:1 + INTVALS + BOOLVALS]
+
+
+# what is subtracted from each axis on the wire
+def _axis_offsets(model_num):
+    return NO_OFFSETS if model_num == MODEL_MIXED else TRIGGER_OFFSETS
+
+
+def _axes_flag(intVals):
+    return FLAG_AXES8 if all(-128 <= v <= 127 for v in intVals) else 0
+
+
+def _wrap(body):
+    frame = bytes((len(body),)) + body
+    return bytes((SYNC,)) + frame + bytes((crc8(frame),))
+
+
+# MODEL, FLAGS and the optional SEQ / STAMP and TAG, seq is a (seq, stamp) tuple or None
+def _header(model_num, flags, seq, tag):
+    if seq is not None:
+        flags |= FLAG_SEQ
+    if tag is not None:
+        flags |= FLAG_TAGGED
+    header = struct.pack('<bB', model_num, flags)
+    if seq is not None:
+        header += struct.pack('<HH', *seq)
+    if tag is not None:
+        header += bytes((tag,))
+    return header
+
+
+def _header_len(flags):
+    return 2 + (4 if flags & FLAG_SEQ else 0) + (1 if flags & FLAG_TAGGED else 0)
+
+
+def encode_binary(model_num, intVals, boolVals, seq=None, tag=None):
+    axes = [v - o for v, o in zip(intVals, _axis_offsets(model_num))]
+    flags = _axes_flag(axes)
+    fmt = f'<{INTVALS}b' if flags & FLAG_AXES8 else f'<{INTVALS}h'
+    return _wrap(_header(model_num, flags, seq, tag) + struct.pack(fmt, *axes) + pack_buttons(boolVals))
+
+
+# (seq, stamp) of a frame body, None if it is not sequenced
+def frame_seq(body):
+    if not body[1] & FLAG_SEQ:
+        return None
+    return struct.unpack_from('<HH', body, 2)
+
+
+# TAG of a frame body, None if it is not tagged
+def frame_tag(body):
+    if not body[1] & FLAG_TAGGED:
+        return None
+    return body[_header_len(body[1]) - 1]
+
+
+# prev is the (model_num, intVals, boolVals) a delta frame applies to
+def decode_binary_body(body, prev=None):
+    model_num, flags = struct.unpack_from('<bB', body)
+    pos = _header_len(flags)
+    if flags & FLAG_DELTA:
+        if prev is None:
+            return None
+        (mask,) = struct.unpack_from('<H', body, pos)
+        pos += 2
+        intVals = list(prev[1])
+        buttons = bytearray(pack_buttons(prev[2]))
+    else:
+        mask = FULL_MASK
+        intVals = [0] * INTVALS
+        buttons = bytearray(BUTTON_BYTES)
+
+    fmt = '<b' if flags & FLAG_AXES8 else '<h'
+    width = struct.calcsize(fmt)
+    offsets = _axis_offsets(model_num)
+    for i in range(INTVALS):
+        if mask >> i & 1:
+            (val,) = struct.unpack_from(fmt, body, pos)
+            intVals[i] = val + offsets[i]
+            pos += width
+    for g in range(BUTTON_BYTES):
+        if mask >> (8 + g) & 1:
+            buttons[g] = body[pos]
+            pos += 1
+    return model_num, intVals, unpack_buttons(buttons)
+
+
+# Delta encoder, sends only what changed and a full keyframe every `keyframe_interval`
+# calls (or when the model changes). Returns None when there is nothing to send.
+#
+# The encoder assumes every frame it returns reaches the port, encode right before
+# writing (see SerialWriter.post) rather than when sampling.
+
+class DeltaEncoder:
+    def __init__(self, keyframe_interval=20):
+        self.keyframe_interval = keyframe_interval
+        self.prev = None
+        self.since_keyframe = 0
+
+        # counters
+        self.keyframes = 0
+        self.deltas = 0
+        self.bytes = 0
+
+    def force_keyframe(self):
+        self.prev = None
+
+    def encode(self, model_num, intVals, boolVals, seq=None, tag=None):
+        buttons = pack_buttons(boolVals)
+        self.since_keyframe += 1
+
+        if self.prev is None or self.prev[0] != model_num or self.since_keyframe >= self.keyframe_interval:
+            frame = encode_binary(model_num, intVals, boolVals, seq, tag)
+            self.since_keyframe = 0
+            self.keyframes += 1
+        else:
+            _, prevInts, prevButtons = self.prev
+            offsets = _axis_offsets(model_num)
+            mask = 0
+            axes = []
+            for i, (v, p) in enumerate(zip(intVals, prevInts)):
+                if v != p:
+                    mask |= 1 << i
+                    axes.append(v - offsets[i])
+            changed = bytearray()
+            for g in range(BUTTON_BYTES):
+                if buttons[g] != prevButtons[g]:
+                    mask |= 1 << (8 + g)
+                    changed.append(buttons[g])
+            if not mask:
+                return None
+
+            flags = FLAG_DELTA | _axes_flag(axes)
+            fmt = f'<H{len(axes)}' + ('b' if flags & FLAG_AXES8 else 'h')
+            frame = _wrap(_header(model_num, flags, seq, tag) + struct.pack(fmt, mask, *axes) + changed)
+            self.deltas += 1
+
+        self.prev = (model_num, list(intVals), buttons)
+        self.bytes += len(frame)
+        return frame
+
+
+# Reference decoder for binary frames, mirrors recvBinaryFrame() in HiTechnic.ino.
+# Bytes can be fed in arbitrary chunks, garbage between frames is skipped.
+# Delta frames are applied to the last decoded frame.
+
+class BinaryDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = None
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped = 0
+        self.unsynced = 0
+
+    def feed(self, data):
+        self.buffer += data
+        buf = self.buffer
+        out = []
+        while True:
+            start = buf.find(SYNC)
+            if start < 0:
+                self.skipped += len(buf)
+                buf.clear()
+                break
+            if start:
+                self.skipped += start
+                del buf[:start]
+            if len(buf) < 2:
+                break
+            length = buf[1]
+            if not 2 <= length <= MAX_BINARY_LEN:
+                self.skipped += 1
+                del buf[:1]
+                continue
+            if len(buf) < length + 3:
+                break
+            frame = bytes(buf[1:length + 2])
+            if crc8(frame) != buf[length + 2]:
+                self.crc_errors += 1
+                del buf[:1]
+                continue
+            del buf[:length + 3]
+            if (decoded := decode_binary_body(frame[1:], self.state)) is None:
+                self.unsynced += 1
+                continue
+            self.state = decoded
+            self.frames += 1
+            out.append(decoded)
+        return out
+
+
+# 'delta' frames are stateful and encoded by a DeltaEncoder owned by each controller
+
+PROTOCOLS = {
+    'text': encode_text,
+    'binary': encode_binary,
+}
+
+
+# text frames have no room for a tag, it is dropped
+def encode_frame(protocol, model_num, intVals, boolVals, tag=None):
+    if tag is not None and protocol == 'binary':
+        return encode_binary(model_num, intVals, boolVals, tag=tag)
+    return PROTOCOLS[protocol](model_num, intVals, boolVals)
+
+
+# round trip check: python protocol.py
+if __name__ == "__main__":
+    import random
+
+    encoder = DeltaEncoder(keyframe_interval=10)
+    decoder = BinaryDecoder()
+    intVals, boolVals = [0] * INTVALS, [0] * BOOLVALS
+    sent = bytearray()
+    for n in range(1000):
+        if random.random() < 0.3:
+            intVals[random.randrange(INTVALS)] = random.choice([random.randint(-100, 100), random.randint(0, 200)])
+        if random.random() < 0.1:
+            boolVals[random.randrange(BOOLVALS)] ^= 1
+        seq = (n, n * 7 & 0xFFFF) if n % 2 else None
+        tag = n % 4 if n % 3 else None
+        if (frame := encoder.encode(0, intVals, boolVals, seq, tag)) is not None:
+            assert frame_seq(frame[2:-1]) == seq, n
+            assert frame_tag(frame[2:-1]) == tag, n
+            sent += frame
+            assert decoder.feed(frame) == [(0, intVals, boolVals)], n
+    full = 1000 * len(encode_binary(0, intVals, boolVals))
+    print(f'ok: {encoder.keyframes} keyframes, {encoder.deltas} deltas, {len(sent)} bytes vs {full} for full frames')
@@ -0,0 +1,216 @@
+import os
+import sys
+import mmap
+import struct
+import argparse
+from time import time, perf_counter, sleep
+from functools import partial
+
+from protocol import INTVALS, BOOLVALS, BUTTON_BYTES, PROTOCOLS, DeltaEncoder, encode_frame, pack_buttons, unpack_buttons
+
+# Session log of the merged frame sent to the ports, for replaying incidents and as a load
+# generator: python recorder.py replay session.rec --com COM6 --speed 4
+#
+# The file is a 32 byte header followed by fixed size records, only ever appended to:
+#
+#   header   MAGIC, version, INTVALS, BOOLVALS, epoch time the file was created
+#   record   t (float64 epoch seconds), connected roles (uint8, the frame's TAG byte,
+#            0 for untagged frames), model (int8), INTVALS int16 axes,
+#            BUTTON_BYTES packed buttons (LSB first)
+#
+# A record is written whenever the frame changes (main.Game.merge_frame, after the
+# filter and the mixer), so a record holds until the next one. A torn record at the end (crash while
+# writing) is ignored by the readers.
+
+MAGIC = b'ROVREC\0\0'
+VERSION = 2  # 1 logged each controller, not the frame sent
+HEADER = struct.Struct('<8sHBBd12x')
+RECORD = struct.Struct(f'<dBb{INTVALS}h{BUTTON_BYTES}s')
+
+
+class Recorder:
+    def __init__(self, path, flush_every=64):
+        self.path = path
+        self.flush_every = flush_every
+        self.records = 0
+
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER.size
+        self.file = open(path, 'ab')
+        if new:
+            self.file.truncate(0)
+            self.file.write(HEADER.pack(MAGIC, VERSION, INTVALS, BOOLVALS, time()))
+        else:
+            with open(path, 'rb') as f:
+                check_header(f.read(HEADER.size))
+            # drop a torn record left by a crash so the records stay aligned
+            size = os.path.getsize(path)
+            self.file.truncate(size - (size - HEADER.size) % RECORD.size)
+
+    def record(self, roles, model_num, intVals, boolVals, t=None):
+        self.file.write(RECORD.pack(time() if t is None else t, roles & 0xFF, model_num, *intVals, pack_buttons(boolVals)))
+        self.records += 1
+        if self.records % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def check_header(data):
+    if len(data) < HEADER.size:
+        raise ValueError('not a session log: too short')
+    magic, version, intvals, boolvals, started = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a session log')
+    if (intvals, boolvals) != (INTVALS, BOOLVALS):
+        raise ValueError(f'log has {intvals} axes / {boolvals} buttons, expected {INTVALS} / {BOOLVALS}')
+    return started
+
+
+# (t, roles, model_num, intVals, boolVals) for every record, read through mmap
+def iter_records(path):
+    with open(path, 'rb') as f:
+        check_header(f.read(HEADER.size))
+        if os.path.getsize(path) < HEADER.size + RECORD.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = (len(mm) - HEADER.size) // RECORD.size
+            for i in range(count):
+                t, roles, model_num, *rest = RECORD.unpack_from(mm, HEADER.size + i * RECORD.size)
+                yield t, roles, model_num, rest[:INTVALS], unpack_buttons(rest[INTVALS])
+
+
+# Columns of a log as a read only NumPy memmap: t, roles, model, axes (n, INTVALS),
+# buttons (n, BUTTON_BYTES), use buttons_array() for one column per button
+def open_array(path):
+    import numpy as np
+
+    dtype = np.dtype([
+        ('t', '<f8'),
+        ('roles', 'u1'),
+        ('model', 'i1'),
+        ('axes', '<i2', (INTVALS,)),
+        ('buttons', 'u1', (BUTTON_BYTES,)),
+    ])
+    assert dtype.itemsize == RECORD.size
+    with open(path, 'rb') as f:
+        check_header(f.read(HEADER.size))
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER.size, shape=(count,))
+
+
+def buttons_array(records):
+    import numpy as np
+
+    return np.unpackbits(records['buttons'], axis=1, bitorder='little')[:, :BOOLVALS]
+
+
+# Streams a log to a writer (anything with post(), e.g. SerialWriter) at `speed` times
+# real time, speed=None sends as fast as the writer takes them (SerialWriter.wait_taken).
+# The records are one stream of frames, so delta frames come from one encoder.
+
+class Replayer:
+    def __init__(self, path, protocol='text', speed=1.0, keyframe_interval=20):
+        if protocol not in PROTOCOLS and protocol != 'delta':
+            raise ValueError(f'Unknown protocol: {protocol!r}')
+        self.path = path
+        self.protocol = protocol
+        self.speed = speed
+        self.keyframe_interval = keyframe_interval
+        self.encoder = DeltaEncoder(keyframe_interval) if protocol == 'delta' else None
+
+        # counters
+        self.frames = 0
+        self.late_max = 0.0
+
+    def frame(self, roles, model_num, intVals, boolVals):
+        tag = roles or None
+        if self.encoder is None:
+            return encode_frame(self.protocol, model_num, intVals, boolVals, tag)
+        return partial(self.encoder.encode, model_num, intVals, boolVals, tag=tag)
+
+    def run(self, writer, done=lambda: False):
+        first = start = None
+        for t, roles, model_num, intVals, boolVals in iter_records(self.path):
+            if done():
+                break
+            if first is None:
+                first, start = t, perf_counter()
+            if not self.speed:
+                writer.wait_taken()
+            else:
+                due = start + (t - first) / self.speed
+                if (wait := due - perf_counter()) > 0:
+                    sleep(wait)
+                else:
+                    self.late_max = max(self.late_max, -wait)
+            writer.post(self.frame(roles, model_num, intVals, boolVals))
+            self.frames += 1
+        return self.frames
+
+
+def info(path):
+    count = 0
+    first = last = None
+    models = set()
+    for t, roles, model_num, *_ in iter_records(path):
+        first = t if first is None else first
+        last = t
+        models.add(model_num)
+        count += 1
+    duration = last - first if count else 0.0
+    print(f'{path}: {count} records, {duration:.1f} s, models {sorted(models)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Session log tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = commands.add_parser('info', help='summary of a log')
+    info_parser.add_argument('path')
+
+    replay = commands.add_parser('replay', help='send a log through a serial port')
+    replay.add_argument('path')
+    replay.add_argument('--com', default='loop://', help='port name or pyserial url')
+    replay.add_argument('--baud', type=int, default=57600)
+    replay.add_argument('--protocol', default='text', choices=['text', 'binary', 'delta'])
+    replay.add_argument('--speed', default='1', help="playback speed, 'max' for no pacing")
+    replay.add_argument('--settle', type=float, default=6, help='seconds to wait after opening the port')
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        info(args.path)
+        return 0
+
+    from serial_link import LineReader, RateController, SerialConnection, SerialWriter
+
+    link = SerialConnection(args.com, args.baud, settle=args.settle).start()
+    if not link.wait_up(args.settle + 10):
+        print(f'{args.com}: {link.state} ({link.last_error})', file=sys.stderr)
+        link.close()
+        return 1
+    replayer = Replayer(args.path, args.protocol, None if args.speed == 'max' else float(args.speed))
+    writer = SerialWriter(link, name=f'writer-{args.com}', budget=RateController(args.baud))
+    if replayer.encoder is not None:
+        writer.on_connect = replayer.encoder.force_keyframe
+    # keeps the vehicle's output (or loop://'s echo) from backing up the port
+    reader = LineReader(link, lambda line, t: True, name=f'reader-{args.com}').start()
+    start = perf_counter()
+    try:
+        replayer.run(writer)
+        writer.wait_taken(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        elapsed = perf_counter() - start
+        stats = writer.stats()
+        reader.close()
+        writer.close()
+        link.close()
+    print(f"{replayer.frames} frames in {elapsed:.1f} s, written {stats['written']}, "
+          f"overwritten {stats['overwritten']}, late max {1000 * replayer.late_max:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
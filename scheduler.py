@@ -0,0 +1,96 @@
+from time import perf_counter, sleep
+
+# Deadline based scheduler for tasks that run at different rates.
+#
+# Every task has an absolute next deadline that advances by exactly one period per
+# run, so timing errors never accumulate. A task that falls more than a period
+# behind skips the missed runs (counted in `overruns`) instead of bursting to catch up.
+# `late` is how far after its deadline a run started, i.e. the jitter.
+
+
+class Task:
+    def __init__(self, name, rate, func):
+        self.name = name
+        self.func = func
+        self.set_rate(rate)
+        self.deadline = None
+
+        # counters
+        self.runs = 0
+        self.overruns = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+        self.run_time_total = 0.0
+        self.run_time_max = 0.0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.period = 1 / rate
+
+    def stats(self):
+        runs = self.runs or 1
+        return {
+            'rate': self.rate,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'late_ms_avg': 1000 * self.late_total / runs,
+            'late_ms_max': 1000 * self.late_max,
+            'run_ms_avg': 1000 * self.run_time_total / runs,
+            'run_ms_max': 1000 * self.run_time_max,
+        }
+
+
+class Scheduler:
+    def __init__(self, clock=perf_counter, sleep=sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.tasks = []
+        self.started = None
+
+    def add(self, name, rate, func):
+        task = Task(name, rate, func)
+        self.tasks.append(task)
+        return task
+
+    def get(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    # runs every task that is due, returns the seconds until the next deadline
+    def run_pending(self):
+        now = self.clock()
+        for task in self.tasks:
+            if task.deadline is None:
+                task.deadline = now
+            if now < task.deadline:
+                continue
+
+            late = now - task.deadline
+            task.func()
+            end = self.clock()
+
+            task.runs += 1
+            task.late_total += late
+            task.late_max = max(task.late_max, late)
+            task.run_time_total += end - now
+            task.run_time_max = max(task.run_time_max, end - now)
+
+            task.deadline += task.period
+            if task.deadline <= end:
+                missed = int((end - task.deadline) / task.period) + 1
+                task.overruns += missed
+                task.deadline += missed * task.period
+            now = end
+
+        return min(task.deadline for task in self.tasks) - self.clock()
+
+    def run(self, done):
+        self.started = self.clock()
+        while not done():
+            if (wait := self.run_pending()) > 0:
+                self.sleep(wait)
+
+    def stats(self):
+        return {task.name: task.stats() for task in self.tasks}
@@ -0,0 +1,510 @@
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+BITS_PER_BYTE = 10  # 8N1: start bit, 8 data bits, stop bit
+
+
+class LinkDown(OSError):
+    pass
+
+
+# Serial port that opens, settles and reconnects in a background thread.
+#
+# Opening the port resets the arduino, so the link only reports 'up' after `settle`
+# seconds. A failed read or write marks the link 'down' and the thread reopens it,
+# backing off from backoff_min up to backoff_max seconds between attempts.
+# Nothing here ever blocks the caller, check `state` / `is_up` instead.
+# `com` is a port name, a pyserial url (e.g. loop:// for testing without hardware) or
+# a tcp:// / udp:// address, see transport.py. Network ports do not reset the arduino
+# and are used right away.
+
+
+class SerialConnection:
+    DOWN = 'down'
+    CONNECTING = 'connecting'
+    SETTLING = 'settling'
+    UP = 'up'
+    CLOSED = 'closed'
+
+    def __init__(self, com, baud, timeout=1, write_timeout=1, settle=6, backoff_min=0.5, backoff_max=8):
+        self.com = com
+        self.baud = baud
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.settle = settle
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+
+        self.ser = None
+        self.state = self.DOWN
+        self.connects = 0
+        self.disconnects = 0
+        self.last_error = None
+        self.settled = 0.0  # seconds the last open waited before going up
+
+        self._up = threading.Event()
+        self._lost = threading.Event()
+        self._closing = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f'link-{com}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def is_up(self):
+        return self._up.is_set()
+
+    def wait_up(self, timeout=None):
+        return self._up.wait(timeout)
+
+    def _run(self):
+        from transport import open_port
+
+        delay = self.backoff_min
+        while not self._closing.is_set():
+            if self._up.is_set():
+                self._lost.wait()
+                self._lost.clear()
+                continue
+
+            self.state = self.CONNECTING
+            try:
+                ser = open_port(self.com, self.baud, timeout=self.timeout, write_timeout=self.write_timeout)
+            except (OSError, ValueError) as e:
+                self.last_error = e
+                self.state = self.DOWN
+                self._closing.wait(delay)
+                delay = min(2 * delay, self.backoff_max)
+                continue
+
+            self.state = self.SETTLING
+            self.settled = self.settle if getattr(ser, 'resets_on_open', True) else 0.0
+            if self._closing.wait(self.settled):
+                ser.close()
+                break
+
+            delay = self.backoff_min
+            self.ser = ser
+            self.connects += 1
+            self.state = self.UP
+            self._up.set()
+
+        self.state = self.CLOSED
+
+    def _mark_lost(self, ser, error):
+        with self._write_lock:
+            if self.ser is not ser:
+                return
+            self.ser = None
+        self._up.clear()
+        self.state = self.DOWN
+        self.disconnects += 1
+        self.last_error = error
+        try:
+            ser.close()
+        except OSError:
+            pass
+        self._lost.set()
+
+    def write(self, data):
+        ser = self.ser
+        if ser is None or not self._up.is_set():
+            raise LinkDown(f'{self.com} is {self.state}')
+        try:
+            with self._write_lock:
+                return ser.write(data)
+        except OSError as e:
+            self._mark_lost(ser, e)
+            raise
+
+    # bytes still queued in the OS / driver output buffer
+    def out_waiting(self):
+        ser = self.ser
+        if ser is None or not self._up.is_set():
+            return 0
+        try:
+            return ser.out_waiting
+        except (OSError, AttributeError):
+            return 0
+
+    def read_all(self):
+        ser = self.ser
+        if ser is None or not self._up.is_set():
+            return b''
+        try:
+            return ser.read_all()
+        except OSError as e:
+            self._mark_lost(ser, e)
+            return b''
+
+    # blocks for up to `timeout` until something arrives, then returns all of it
+    def read_some(self):
+        ser = self.ser
+        if ser is None or not self._up.is_set():
+            return b''
+        try:
+            if (data := ser.read(1)):
+                data += ser.read_all()
+            return data
+        except OSError as e:
+            self._mark_lost(ser, e)
+            return b''
+        except TypeError:
+            # pyserial read on a port a failed write closed meanwhile (fd is None)
+            return b''
+
+    def close(self, timeout=1):
+        self._closing.set()
+        self._lost.set()
+        self._up.clear()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+        self.state = self.CLOSED
+
+
+# Keeps the transmit rate inside what the link can carry.
+#
+# At `baud` the link moves baud / BITS_PER_BYTE bytes per second, so with the current
+# frame size it can carry at most `capacity_hz` frames per second. The writer calls
+# wait_for_room() before every write and only writes once the output buffer has
+# drained, so at most one frame is ever queued and newer frames coalesce in the
+# mailbox instead of piling up. `rate` is the suggested transmit rate, capacity_hz
+# (or max_rate) while writes go through, the measured throughput once they back up.
+
+
+class RateController:
+    def __init__(self, baud, max_rate=250, min_rate=5, headroom=0.9, window=1.0):
+        self.baud = baud
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.headroom = headroom
+        self.window = window
+
+        self.frame_bytes = 0.0
+        self.rate = max_rate
+        self.queue_depth = 0
+        self.waits = 0
+        self._waited = False
+        self._writes = deque()  # (time, bytes) of the writes inside `window`
+
+    @property
+    def byte_rate(self):
+        return self.baud / BITS_PER_BYTE
+
+    @property
+    def capacity_hz(self):
+        if not self.frame_bytes:
+            return self.max_rate
+        return self.headroom * self.byte_rate / self.frame_bytes
+
+    def wait_for_room(self, link, closed=lambda: False):
+        while (queued := link.out_waiting()) > 0 and not closed():
+            self.queue_depth = queued
+            self.waits += 1
+            self._waited = True
+            sleep(queued / self.byte_rate)
+        self.queue_depth = 0
+
+    def on_write(self, nbytes, now=None):
+        now = perf_counter() if now is None else now
+        self.frame_bytes = nbytes if not self.frame_bytes else 0.9 * self.frame_bytes + 0.1 * nbytes
+        self._writes.append((now, nbytes))
+        while self._writes and now - self._writes[0][0] > self.window:
+            self._writes.popleft()
+
+        # while the port keeps up the configured baud is the limit, once it backs up
+        # the measured drain rate is
+        rate = min(self.max_rate, self.capacity_hz)
+        if self._waited and (throughput := self.throughput):
+            rate = min(rate, throughput / self.frame_bytes)
+        self.rate = max(self.min_rate, rate)
+        self._waited = False
+
+    @property
+    def achieved_hz(self):
+        if len(self._writes) < 2:
+            return 0.0
+        return (len(self._writes) - 1) / (self._writes[-1][0] - self._writes[0][0] or 1)
+
+    @property
+    def throughput(self):
+        if len(self._writes) < 2:
+            return 0.0
+        return sum(n for _, n in list(self._writes)[1:]) / (self._writes[-1][0] - self._writes[0][0] or 1)
+
+    def stats(self):
+        return {
+            'rate_hz': self.rate,
+            'achieved_hz': self.achieved_hz,
+            'capacity_hz': self.capacity_hz,
+            'throughput_bps': self.throughput,
+            'frame_bytes': self.frame_bytes,
+            'queue_depth': self.queue_depth,
+            'waits': self.waits,
+        }
+
+
+# Background writer for one serial link.
+#
+# The control loop posts encoded frames into a single slot mailbox and never waits
+# on the port. The writer thread always sends the newest frame, a frame that is
+# replaced before the thread picks it up is counted in `overwritten` and dropped.
+# While the link is down the newest frame is held and sent as soon as it comes back.
+# A posted frame can also be a callable returning bytes (or None to skip), it is called
+# right before the write (used for delta frames).
+# The arduino resets when the port is (re)opened and forgets the last frame, deltas
+# are ignored until it gets a full one again. `on_connect` (e.g. DeltaEncoder.
+# force_keyframe) is called on the writer thread before the first frame after every
+# connect, ahead of the callable, so that frame is encoded whole.
+# With a RateController (`budget`) the writer also waits for the port to drain
+# before each write, see RateController.
+
+
+class SerialWriter:
+    def __init__(self, link, name='serial-writer', budget=None):
+        self.link = link
+        self.budget = budget
+        self._cond = threading.Condition()
+        self._pending = None
+        self._closed = False
+        self.on_connect = None
+        self._connects = 0  # link.connects at the last frame
+
+        # counters
+        self.posted = 0
+        self.written = 0
+        self.overwritten = 0
+        self.errors = 0
+        self.last_error = None
+        self.bytes_written = 0
+        self.write_time_last = 0.0
+        self.write_time_max = 0.0
+        self.write_time_total = 0.0
+        self.first_write = None  # perf_counter() after the first frame went out
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def post(self, frame):
+        with self._cond:
+            if self._pending is not None:
+                self.overwritten += 1
+            self._pending = frame
+            self.posted += 1
+            self._cond.notify_all()
+
+    # blocks until the writer has taken the pending frame, for senders that must not drop any
+    def wait_taken(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending is None or self._closed, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+            if self.budget is not None:
+                self.budget.wait_for_room(self.link, lambda: self._closed)
+
+            with self._cond:
+                if self._closed:
+                    return
+                frame, self._pending = self._pending, None
+                self._cond.notify_all()
+
+            if not self.link.wait_up(0.5):
+                self._hold(frame)
+                continue
+
+            if self.link.connects != self._connects:
+                self._connects = self.link.connects
+                if self.on_connect is not None:
+                    self.on_connect()
+
+            if callable(frame) and (frame := frame()) is None:
+                continue
+
+            start = perf_counter()
+            try:
+                self.link.write(frame)
+            except OSError as e:  # serial.SerialException is an OSError
+                self.errors += 1
+                self.last_error = e
+                self._hold(frame)
+                continue
+            elapsed = perf_counter() - start
+
+            if self.budget is not None:
+                self.budget.on_write(len(frame), start + elapsed)
+            if self.first_write is None:
+                self.first_write = start + elapsed
+            self.written += 1
+            self.bytes_written += len(frame)
+            self.write_time_last = elapsed
+            self.write_time_total += elapsed
+            if elapsed > self.write_time_max:
+                self.write_time_max = elapsed
+
+    # put an unsent frame back unless a newer one arrived meanwhile
+    def _hold(self, frame):
+        with self._cond:
+            if self._pending is None:
+                self._pending = frame
+
+    def stats(self):
+        budget = self.budget.stats() if self.budget is not None else {}
+        return budget | {
+            'posted': self.posted,
+            'written': self.written,
+            'overwritten': self.overwritten,
+            'errors': self.errors,
+            'bytes_written': self.bytes_written,
+            'write_ms_last': 1000 * self.write_time_last,
+            'write_ms_max': 1000 * self.write_time_max,
+            'write_ms_avg': 1000 * self.write_time_total / self.written if self.written else 0.0,
+        }
+
+    def close(self, timeout=1):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+# Incremental line framing for what the vehicle sends.
+#
+# Bytes are buffered until a newline and only complete lines are decoded, so utf-8
+# characters split across reads stay intact. A line longer than `max_line` (missing
+# newline, noise) is dropped instead of growing the buffer.
+
+
+class LineSplitter:
+    def __init__(self, max_line=1024):
+        self.max_line = max_line
+        self._buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        self._buffer += data
+        *complete, rest = self._buffer.split(b'\n')
+        if len(rest) > self.max_line:
+            self.dropped += 1
+            rest = b''
+        self._buffer = bytearray(rest)
+        lines = []
+        for raw in complete:
+            if (line := raw.decode(errors='replace').rstrip('\r')):
+                lines.append(line)
+        return lines
+
+    def reset(self):
+        self._buffer.clear()
+
+
+# Background reader for one serial link, splits what the vehicle sends into lines.
+#
+# Every complete line goes to `handler(line, t)` with the time it was read, lines
+# the handler does not claim (returns False) are queued in `lines` for the main loop
+# to print. Reading on its own thread keeps arrival times independent of the loop rate.
+
+
+class LineReader:
+    def __init__(self, link, handler=None, name='serial-reader', maxlen=256):
+        self.link = link
+        self.handler = handler
+        self.lines = deque(maxlen=maxlen)
+        self.splitter = LineSplitter()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._closed:
+            if not self.link.wait_up(0.5):
+                self.splitter.reset()
+                continue
+            if not (data := self.link.read_some()):
+                continue
+            now = perf_counter()
+            for line in self.splitter.feed(data):
+                if self.handler is None or not self.handler(line, now):
+                    self.lines.append(line)
+
+    def pop_lines(self):
+        lines = []
+        while self.lines:
+            lines.append(self.lines.popleft())
+        return lines
+
+    def close(self, timeout=1):
+        self._closed = True
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+# One connection per serial port for the whole program.
+#
+# A Port bundles the SerialConnection with its writer and line reader. PortPool.open()
+# returns the existing Port for a name and only creates one on first use, so however
+# many controllers send to a port there is a single writer and frames never interleave.
+# Every Port writes on its own thread, so a slow or stalled board only backs up its own
+# mailbox and the other ports keep getting frames.
+
+
+class Port:
+    def __init__(self, com, baud, handler=None, max_rate=250, settle=6):
+        self.com = com
+        self.baud = baud
+        self.link = SerialConnection(com, baud, settle=settle).start()
+        self.writer = SerialWriter(self.link, name=f'writer-{com}', budget=RateController(baud, max_rate=max_rate))
+        self.reader = LineReader(self.link, handler, name=f'reader-{com}').start()
+
+    # health (link state, reconnects, last error) and the writer's counters
+    def stats(self):
+        return self.writer.stats() | {
+            'state': self.link.state,
+            'reconnects': max(self.link.connects - 1, 0),
+            'disconnects': self.link.disconnects,
+            'last_error': str(self.link.last_error) if self.link.last_error is not None else None,
+        }
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+        self.link.close()
+
+
+class PortPool:
+    def __init__(self):
+        self.ports = {}
+        self._lock = threading.Lock()
+
+    def open(self, com, baud, handler=None, max_rate=250, settle=6):
+        with self._lock:
+            if (port := self.ports.get(com)) is not None:
+                if port.baud != baud:
+                    raise ValueError(f'{com} is already open at {port.baud} baud')
+                return port
+            port = self.ports[com] = Port(com, baud, handler, max_rate, settle)
+            return port
+
+    def get(self, com):
+        return self.ports.get(com)
+
+    def close(self):
+        with self._lock:
+            ports, self.ports = list(self.ports.values()), {}
+        for port in ports:
+            port.close()
@@ -0,0 +1,77 @@
+from array import array
+
+from protocol import INTVALS, BOOLVALS
+
+# Per-controller input state, allocated once and updated in place every frame.
+#
+# axes / buttons are array('h') / array('B') in wire order (at least INTVALS /
+# BOOLVALS long, generic controllers may have more). wire_axes / wire_buttons are
+# memoryviews of the wire slice that the encoders read directly. `version` is bumped
+# whenever a value changes, so senders can skip frames that did not change.
+
+
+class StateView:
+    __slots__ = ('names', 'data', 'index')
+
+    # read only, dict like view of an array for the UI
+    def __init__(self, names, data):
+        self.names = list(names)
+        self.data = data
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        return self.data[self.index[name]]
+
+    def keys(self):
+        return iter(self.names)
+
+    def values(self):
+        return iter(self.data[:len(self.names)])
+
+    def items(self):
+        return zip(self.names, self.data)
+
+
+class ControllerState:
+    __slots__ = ('axes', 'buttons', 'hats', 'wire_axes', 'wire_buttons', 'version',
+                 'axes_view', 'buttons_view', 'hats_view')
+
+    def __init__(self, axis_names, button_names, numhats=0):
+        axis_names, button_names = list(axis_names), list(button_names)
+        self.axes = array('h', [0]) * max(len(axis_names), INTVALS)
+        self.buttons = array('B', [0]) * max(len(button_names), BOOLVALS)
+        self.hats = array('b', [0]) * (2 * numhats)  # x, y per hat
+        self.wire_axes = memoryview(self.axes)[:INTVALS]
+        self.wire_buttons = memoryview(self.buttons)[:BOOLVALS]
+        self.version = 0
+
+        self.axes_view = StateView(axis_names, self.axes)
+        self.buttons_view = StateView(button_names, self.buttons)
+        self.hats_view = StateView([f'{i}{xy}' for i in range(numhats) for xy in 'xy'], self.hats)
+
+    def set_axis(self, i, val):
+        if self.axes[i] != val:
+            self.axes[i] = val
+            self.version += 1
+
+    def set_button(self, i, val):
+        if self.buttons[i] != val:
+            self.buttons[i] = val
+            self.version += 1
+
+    def set_hat(self, i, val):
+        x, y = val
+        if self.hats[2 * i] != x or self.hats[2 * i + 1] != y:
+            self.hats[2 * i] = x
+            self.hats[2 * i + 1] = y
+            self.version += 1
+
+    # copy of the wire values, for consumers that hold on to them across frames
+    def snapshot(self):
+        return self.wire_axes.tolist(), self.wire_buttons.tolist()
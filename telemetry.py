@@ -0,0 +1,150 @@
+import threading
+from array import array
+from collections import namedtuple
+from time import perf_counter
+
+# Telemetry records sent by the vehicle, one per line: "<KIND> <int> <int> ...".
+#
+# Every known kind has a fixed list of integer fields and its own RingBuffer, a
+# preallocated array of `capacity` records that overwrites the oldest one. Memory is
+# fixed up front and storing a record is a few array writes, however fast the
+# firmware talks. Lines of unknown kinds are left to the caller (printed).
+# Records are stored by the serial reader thread, queries can come from any thread.
+
+
+class RecordType:
+    def __init__(self, kind, fields, typecode='l'):
+        self.kind = kind
+        self.fields = tuple(fields)
+        self.typecode = typecode
+        self.record = namedtuple(kind, ('t',) + self.fields)
+
+
+RECORD_TYPES = {
+    # MotorController::get_current_encoder_value of both motors on both drivers
+    'ENC': RecordType('ENC', ('m1', 'm2', 'm3', 'm4')),
+    # power last passed to move_power, -100..100, -128 is float
+    'PWR': RecordType('PWR', ('m1', 'm2', 'm3', 'm4')),
+    # answer to a sequenced frame, see latency.py
+    'ACK': RecordType('ACK', ('seq', 'stamp')),
+}
+
+
+class RingBuffer:
+    def __init__(self, record_type, capacity=1024):
+        self.type = record_type
+        self.width = len(record_type.fields)
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = array(record_type.typecode, [0]) * (capacity * self.width)
+        self.head = 0   # slot the next record goes to
+        self.count = 0  # records held, at most capacity
+        self.total = 0  # records ever appended
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, values):
+        i = self.head
+        self.times[i] = t
+        self.values[i * self.width:(i + 1) * self.width] = array(self.type.typecode, values)
+        self.head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.total += 1
+
+    # slot of the k-th oldest record held
+    def _slot(self, k):
+        return (self.head - self.count + k) % self.capacity
+
+    def _record(self, k):
+        i = self._slot(k)
+        return self.type.record(self.times[i], *self.values[i * self.width:(i + 1) * self.width])
+
+    def latest(self):
+        return self._record(self.count - 1) if self.count else None
+
+    # the last n records, oldest first
+    def last(self, n):
+        n = min(n, self.count)
+        return [self._record(k) for k in range(self.count - n, self.count)]
+
+    # records newer than t, oldest first
+    def since(self, t):
+        return [self._record(k) for k in range(self._first_after(t), self.count)]
+
+    # records with t0 <= t < t1, oldest first
+    def between(self, t0, t1):
+        return [self._record(k) for k in range(self._first_after(t0, inclusive=True), self._first_after(t1, inclusive=True))]
+
+    # one field of the last n records, for plotting
+    def series(self, field, n=None):
+        f = self.type.fields.index(field)
+        n = self.count if n is None else min(n, self.count)
+        return [self.values[self._slot(k) * self.width + f] for k in range(self.count - n, self.count)]
+
+    # index (oldest = 0) of the first record after t, records are in time order
+    def _first_after(self, t, inclusive=False):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            before = self.times[self._slot(mid)] < t if inclusive else self.times[self._slot(mid)] <= t
+            if before:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class Telemetry:
+    def __init__(self, capacity=1024, types=RECORD_TYPES, clock=perf_counter):
+        self.types = types
+        self.clock = clock
+        self.buffers = {kind: RingBuffer(record_type, capacity) for kind, record_type in types.items()}
+        self._lock = threading.Lock()
+
+        # counters
+        self.records = 0
+        self.malformed = 0
+
+    # stores the line if it is a known record, returns True if it was one
+    def on_line(self, line, now=None):
+        kind, _, rest = line.partition(' ')
+        if (buffer := self.buffers.get(kind)) is None:
+            return False
+        try:
+            values = [int(v) for v in rest.split()]
+        except ValueError:
+            values = None
+        if values is None or len(values) != buffer.width:
+            self.malformed += 1
+            return True
+        with self._lock:
+            buffer.append(self.clock() if now is None else now, values)
+            self.records += 1
+        return True
+
+    def latest(self, kind):
+        with self._lock:
+            return self.buffers[kind].latest()
+
+    def last(self, kind, n):
+        with self._lock:
+            return self.buffers[kind].last(n)
+
+    def since(self, kind, t):
+        with self._lock:
+            return self.buffers[kind].since(t)
+
+    def between(self, kind, t0, t1):
+        with self._lock:
+            return self.buffers[kind].between(t0, t1)
+
+    def series(self, kind, field, n=None):
+        with self._lock:
+            return self.buffers[kind].series(field, n)
+
+    def stats(self):
+        return {
+            'records': self.records,
+            'malformed': self.malformed,
+        } | {kind: buffer.total for kind, buffer in self.buffers.items()}
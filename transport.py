@@ -0,0 +1,325 @@
+import select
+import socket
+from urllib.parse import urlsplit
+
+from protocol import SYNC
+
+# Where the frames go: python cli.py --com tcp://192.168.2.2:5760 (or udp://, or a port)
+#
+# open_port() opens `com` and returns an object with the part of the pyserial port
+# interface serial_link.SerialConnection and async_game use (write, read, read_all,
+# in_waiting, out_waiting, fileno, close), so everything above it works the same over
+# every backend:
+#
+#   tcp://host:port   a companion computer on the tether. TCP_NODELAY so every frame
+#                     leaves at once instead of waiting for Nagle, keepalive so a cut
+#                     tether is noticed. out_waiting is the unacknowledged bytes in the
+#                     socket, which the RateController waits on like a serial buffer.
+#   udp://host:port   one connected socket, each write goes out in as few datagrams
+#                     as fit MAX_DATAGRAM, split only between frames / lines, so a lost
+#                     datagram only ever loses whole frames.
+#   anything else     pyserial: a port name or a pyserial url (loop://, socket://, ...)
+#
+# The bytes are the same frames (protocol.py) on every backend. Opening a network port
+# does not reset the arduino, so there is nothing to settle (`resets_on_open`). One
+# connection per port for the whole program is serial_link.PortPool's job, a link
+# that drops is reopened by SerialConnection.
+#
+# listen() opens the other end, for the virtual ROV (virtual_rov.py --listen) and tests.
+
+NETWORK_SCHEMES = ('tcp', 'udp')
+MAX_DATAGRAM = 1472  # UDP payload that fits one ethernet frame
+
+
+# (scheme, host, port) of a tcp:// / udp:// url, None for anything else
+def parse_url(com):
+    if '://' not in com:
+        return None
+    url = urlsplit(com)
+    if url.scheme not in NETWORK_SCHEMES:
+        return None
+    if not url.hostname or url.port is None:
+        raise ValueError(f'expected {url.scheme}://host:port, got {com!r}')
+    return url.scheme, url.hostname, url.port
+
+
+def is_network(com):
+    return parse_url(com) is not None
+
+
+def open_port(com, baud, timeout=None, write_timeout=None):
+    if (url := parse_url(com)) is None:
+        import serial
+
+        return serial.serial_for_url(com, baud, timeout=timeout, write_timeout=write_timeout)
+    scheme, host, port = url
+    if scheme == 'tcp':
+        return TcpPort(host, port, timeout, write_timeout)
+    return UdpPort(host, port, timeout, write_timeout)
+
+
+def listen(com):
+    scheme, host, port = parse_url(com) or (None, None, None)
+    if scheme == 'tcp':
+        return TcpListener(host, port)
+    if scheme == 'udp':
+        return UdpListener(host, port)
+    raise ValueError(f'expected tcp://host:port or udp://host:port, got {com!r}')
+
+
+# splits data into chunks of at most `limit` bytes, only after a whole binary frame,
+# a ']' or a newline (a single frame / line longer than `limit` is a chunk of its own)
+def pack_datagrams(data, limit=MAX_DATAGRAM):
+    chunks = []
+    start = end = 0
+    n = len(data)
+    while end < n:
+        if data[end] == SYNC and end + 1 < n:
+            nxt = min(end + data[end + 1] + 3, n)
+        else:
+            nxt = n
+            for marker in (b']', b'\n'):
+                if (pos := data.find(marker, end)) >= 0:
+                    nxt = min(nxt, pos + 1)
+        if nxt - start > limit and end > start:
+            chunks.append(data[start:end])
+            start = end
+        end = nxt
+    if start < n:
+        chunks.append(data[start:])
+    return chunks
+
+
+def _readable(sock, timeout):
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+# an int ioctl on the socket (termios.<name>), 0 where there is none (windows)
+def _ioctl_int(sock, name):
+    try:
+        import fcntl
+        import struct
+        import termios
+
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), getattr(termios, name), b'\0\0\0\0'))[0]
+    except (ImportError, AttributeError, OSError, ValueError):
+        return 0
+
+
+# timeout / write_timeout follow pyserial: None blocks, 0 returns at once
+class _SocketPort:
+    resets_on_open = False
+
+    def __init__(self, sock, timeout=None, write_timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.sock.settimeout(write_timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def in_waiting(self):
+        return _ioctl_int(self.sock, 'FIONREAD')
+
+    def close(self):
+        self.sock.close()
+
+
+class TcpPort(_SocketPort):
+    def __init__(self, host, port, timeout=None, write_timeout=None, connect_timeout=5):
+        sock = socket.create_connection((host, port), timeout=connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        super().__init__(sock, timeout, write_timeout)
+
+    def write(self, data):
+        if self.write_timeout == 0:
+            try:
+                return self.sock.send(data)
+            except BlockingIOError:
+                return 0
+        self.sock.sendall(data)
+        return len(data)
+
+    # waits up to `timeout` for data, then returns what arrived (at most `size` bytes)
+    def read(self, size=1):
+        if not _readable(self.sock, self.timeout):
+            return b''
+        return self._recv(size)
+
+    def read_all(self):
+        data = b''
+        while _readable(self.sock, 0):
+            data += self._recv(1 << 16)
+        return data
+
+    def _recv(self, size):
+        try:
+            data = self.sock.recv(size)
+        except BlockingIOError:
+            return b''
+        if not data:
+            raise ConnectionResetError(f'{self.sock.getpeername()} closed the connection')
+        return data
+
+    # bytes the other end has not acknowledged yet (TIOCOUTQ is SIOCOUTQ on linux)
+    @property
+    def out_waiting(self):
+        return _ioctl_int(self.sock, 'TIOCOUTQ')
+
+
+class UdpPort(_SocketPort):
+    def __init__(self, host, port, timeout=None, write_timeout=None, max_datagram=MAX_DATAGRAM):
+        family, kind, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        sock = socket.socket(family, kind, proto)
+        sock.connect(address)  # send() needs no address, only the peer's replies come in
+        super().__init__(sock, timeout, write_timeout)
+        self.max_datagram = max_datagram
+        self._buffer = bytearray()
+
+        # counters
+        self.datagrams = 0
+
+    def write(self, data):
+        for chunk in pack_datagrams(bytes(data), self.max_datagram):
+            try:
+                self.sock.send(chunk)
+            except BlockingIOError:
+                return 0
+            self.datagrams += 1
+        return len(data)
+
+    def read(self, size=1):
+        if not self._buffer and _readable(self.sock, self.timeout):
+            self._drain()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_all(self):
+        self._drain()
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def _drain(self):
+        while _readable(self.sock, 0):
+            self._buffer += self.sock.recv(1 << 16)
+
+    @property
+    def in_waiting(self):
+        self._drain()
+        return len(self._buffer)
+
+    @property
+    def out_waiting(self):
+        return 0
+
+
+# The vehicle's end, never blocks: read() returns what has arrived (at most `size`
+# bytes), write() answers the current peer and is dropped when there is none.
+
+class TcpListener:
+    def __init__(self, host, port):
+        self.server = socket.create_server((host, port))
+        self.server.setblocking(False)
+        self.client = None
+        self.accepted = 0
+        self._buffer = bytearray()
+
+    @property
+    def address(self):
+        host, port = self.server.getsockname()[:2]
+        return f'tcp://{host}:{port}'
+
+    def read(self, size):
+        try:
+            client, _ = self.server.accept()
+        except BlockingIOError:
+            pass
+        else:
+            # the topside reconnected, the old connection is dead
+            if self.client is not None:
+                self.client.close()
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.client = client
+            self.accepted += 1
+            self._buffer.clear()
+        if self.client is not None and size > len(self._buffer):
+            try:
+                data = self.client.recv(1 << 16)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._drop()
+            else:
+                if data:
+                    self._buffer += data
+                else:
+                    self._drop()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        if self.client is None:
+            return
+        try:
+            self.client.send(data)
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop()
+
+    def _drop(self):
+        self.client.close()
+        self.client = None
+
+    def close(self):
+        if self.client is not None:
+            self._drop()
+        self.server.close()
+
+
+class UdpListener:
+    def __init__(self, host, port, max_datagram=MAX_DATAGRAM):
+        family, kind, proto, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, kind, proto)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.max_datagram = max_datagram
+        self.peer = None
+        self.datagrams = 0
+        self._buffer = bytearray()
+
+    @property
+    def address(self):
+        host, port = self.sock.getsockname()[:2]
+        return f'udp://{host}:{port}'
+
+    def read(self, size):
+        while size > len(self._buffer):
+            try:
+                data, self.peer = self.sock.recvfrom(1 << 16)
+            except (BlockingIOError, ConnectionResetError):
+                break
+            self._buffer += data
+            self.datagrams += 1
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        if self.peer is None:
+            return
+        for chunk in pack_datagrams(bytes(data), self.max_datagram):
+            try:
+                self.sock.sendto(chunk, self.peer)
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
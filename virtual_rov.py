@@ -0,0 +1,482 @@
+import os
+import re
+import sys
+import argparse
+from collections import deque
+from time import perf_counter, sleep
+
+from protocol import SYNC, FLAG_AXES8, FLAG_DELTA, FLAG_SEQ, FLAG_TAGGED, BUTTON_BYTES, MAX_BINARY_LEN, INTVALS, crc8
+
+# Stand-in for the vehicle: python virtual_rov.py [--baud 9600] [--binary]
+#
+# Opens a pty (or --com, any pyserial port / url, or --listen tcp:// / udp://, the
+# companion computer forwarding to the arduino) and behaves like HiTechnic.ino on the
+# other end, so framing and throughput changes can be load tested without an arduino:
+#
+#   - bytes arrive at the baud's byte rate (10 bits per byte) into the 64 byte receive
+#     buffer of the AVR core, bytes arriving while it is full are lost
+#   - loop() takes one frame per pass, recvWithStartEndMarkers / parseData (text) or
+#     recvBinaryFrame / parseBinaryData (binary) reproduced with their limits: 64 char
+#     receivedChars, intValues[4], booleanValues[18], model 0 and modelMixed only
+#   - useParsedData maps the values to the four motor powers like the firmware, and a
+#     frame keeps the loop busy for --process-ms (the two move_power I2C writes), with
+#     --telemetry (SEND_TELEMETRY) the telemetry lines another --telemetry-ms every 100 ms
+#   - replies are what the firmware prints: the empty line of parseData, ACK lines for
+#     sequenced binary frames, ENC / PWR telemetry with --telemetry
+#
+# Every second it prints the achieved command rate and the frames that were truncated
+# (text over 63 chars), dropped (lost bytes in the receive buffer) or late (acted on
+# more than --late-ms after they were sent, after their first byte arrived for frames
+# without a STAMP). The emulation runs on the wire's timeline, so the results do not
+# depend on how often this process gets to run. VirtualROV.feed() can also be driven
+# from code with any clock, see bench.py.
+
+RX_BUFFER = 64   # SERIAL_RX_BUFFER_SIZE of the AVR core
+NUM_CHARS = 64   # numChars
+FIRMWARE_INTS = 4
+FIRMWARE_BOOLS = 18
+MODEL_MIXED = 2  # modelMixed
+TELEMETRY_INTERVAL = 0.1  # telemetryInterval
+ENC_PER_POWER_S = 10  # encoder counts per second per unit of power, for the ENC lines
+
+HORIZON = 0.002  # how far ahead of the clock bytes are taken off the port, s
+
+
+# atoi() on the arduino: leading blanks, a sign, digits, 0 if there are none, 16 bit int
+def atoi(token):
+    if token is None or (match := re.match(rb'\s*([+-]?\d+)', token)) is None:
+        return 0
+    return (int(match.group(1)) + 0x8000 & 0xFFFF) - 0x8000
+
+
+# recvWithStartEndMarkers + parseData
+class TextFirmware:
+    def __init__(self):
+        self.received = bytearray(NUM_CHARS)
+        self.ndx = 0
+        self.in_progress = False
+        self.overflowed = False
+
+        # counters
+        self.truncated = 0       # frames longer than numChars - 1, the end is lost
+        self.missing_tokens = 0  # frames with fewer tokens than parseData reads (atoi(NULL))
+
+    # one byte of recvWithStartEndMarkers, returns True when a frame is complete
+    def recv(self, rc):
+        if self.in_progress:
+            if rc != 0x5D:  # ']'
+                self.received[self.ndx] = rc
+                self.ndx += 1
+                if self.ndx >= NUM_CHARS:
+                    self.ndx = NUM_CHARS - 1
+                    self.overflowed = True
+                return False
+            self.frame = bytes(self.received[:self.ndx])
+            if self.overflowed:
+                self.truncated += 1
+            self.in_progress = False
+            self.overflowed = False
+            self.ndx = 0
+            return True
+        if rc == 0x5B:  # '['
+            self.in_progress = True
+        return False
+
+    # parseData, returns True if the model was one the firmware handles
+    def parse(self, rov):
+        tokens = iter([token for token in self.frame.split(b',') if token])  # strtok skips empty tokens
+        model_num = atoi(next(tokens, None))
+        if model_num not in (0, MODEL_MIXED):
+            return False
+        missing = False
+        for i in range(FIRMWARE_INTS):
+            token = next(tokens, None)
+            missing = missing or token is None
+            rov.ints[i] = atoi(token)
+        rov.reply(b'\r\n')  # Serial.println()
+        for i in range(FIRMWARE_BOOLS):
+            token = next(tokens, None)
+            missing = missing or token is None
+            rov.bools[i] = atoi(token) != 0
+        if missing:
+            self.missing_tokens += 1
+        return True
+
+
+# recvBinaryFrame + parseBinaryData
+class BinaryFirmware:
+    def __init__(self):
+        self.received = bytearray(MAX_BINARY_LEN)  # keeps old bytes like receivedBytes
+        self.state = 0
+        self.length = 0
+        self.ndx = 0
+        self.crc = 0
+        self.synced = False
+        self.seq = None
+
+        # counters
+        self.crc_errors = 0
+        self.unsynced = 0  # deltas before the first full frame
+
+    def recv(self, rb):
+        if self.state == 0:
+            if rb == SYNC:
+                self.state = 1
+        elif self.state == 1:
+            if rb < 2 or rb > MAX_BINARY_LEN:
+                self.state = 1 if rb == SYNC else 0
+                return False
+            self.length = rb
+            self.crc = crc8((rb,))
+            self.ndx = 0
+            self.state = 2
+        elif self.state == 2:
+            self.received[self.ndx] = rb
+            self.ndx += 1
+            self.crc = crc8((rb,), self.crc)
+            if self.ndx >= self.length:
+                self.state = 3
+        else:
+            self.state = 0
+            if rb == self.crc:
+                return True
+            self.crc_errors += 1
+        return False
+
+    def parse(self, rov):
+        data = self.received
+        model_num = data[0] - 256 if data[0] > 127 else data[0]
+        flags = data[1]
+        ndx = 2
+        mask = 0xFFFF
+        seq = None
+        if flags & FLAG_SEQ:
+            seq = (data[ndx] | data[ndx + 1] << 8, data[ndx + 2] | data[ndx + 3] << 8)
+            ndx += 4
+        if flags & FLAG_TAGGED:
+            ndx += 1
+        if flags & FLAG_DELTA:
+            if not self.synced:
+                self.unsynced += 1
+                return False
+            mask = data[ndx] | data[ndx + 1] << 8
+            ndx += 2
+        if model_num not in (0, MODEL_MIXED):
+            return False
+
+        for i in range(INTVALS):
+            if not mask >> i & 1:
+                continue
+            if flags & FLAG_AXES8:
+                val = data[ndx] - 256 if data[ndx] > 127 else data[ndx]
+                ndx += 1
+            else:
+                val = data[ndx] | data[ndx + 1] << 8
+                val = val - 0x10000 if val > 0x7FFF else val
+                ndx += 2
+            if i < FIRMWARE_INTS:
+                rov.ints[i] = val
+        for g in range(BUTTON_BYTES):
+            if not mask >> (8 + g) & 1:
+                continue
+            for i in range(8 * g, min(8 * g + 8, FIRMWARE_BOOLS)):
+                rov.bools[i] = bool(data[ndx] >> (i % 8) & 1)
+            ndx += 1
+        if not flags & FLAG_DELTA:
+            self.synced = True
+        self.seq = seq
+        return True
+
+
+# useParsedData: brake, full forward / reverse buttons, else the value, 0 floats (-128)
+def use_parsed_data(ints, bools):
+    b = bools
+    return [
+        0 if b[8] else 100 if b[5] else -100 if b[4] else -128 if ints[0] == 0 else ints[0],
+        0 if b[10] else 100 if b[7] else -100 if b[6] else -128 if ints[1] == 0 else ints[1],
+        0 if b[9] else 100 if b[1] else -100 if b[2] else -128 if ints[2] == 0 else ints[2],
+        0 if b[11] else 100 if b[0] else -100 if b[3] else -128 if ints[3] == 0 else ints[3],
+    ]
+
+
+class VirtualROV:
+    def __init__(self, baud=9600, binary=False, process_ms=2.0, late_ms=50.0, telemetry=False, telemetry_ms=4.0, window=1.0):
+        self.baud = baud
+        self.byte_time = 10 / baud
+        self.binary = binary
+        self.firmware = BinaryFirmware() if binary else TextFirmware()
+        self.process_time = process_ms / 1000
+        self.late_ms = late_ms
+        self.telemetry = telemetry
+        self.telemetry_time = telemetry_ms / 1000
+        self.window = window
+
+        # firmware state
+        self.ints = [0] * FIRMWARE_INTS
+        self.bools = [False] * FIRMWARE_BOOLS
+        self.motors = use_parsed_data(self.ints, self.bools)
+        self.encoders = [0.0] * 4
+        self.moved = None
+
+        self.rx = deque()       # (byte, arrival time) in the receive buffer
+        self.wire_free = None   # when the line is done with the bytes taken so far
+        self.busy_until = 0.0   # the loop is parsing / driving the motors until then
+        self.next_telemetry = None
+        self.frame_start = None  # arrival of the first byte of the frame being received
+        self.replies = bytearray()
+
+        # wire side framing, to tell which frame a lost byte belonged to
+        self.wire_left = 0
+        self.wire_len_next = False
+        self.damaged = 0
+
+        # counters
+        self.bytes = 0
+        self.wire_frames = 0
+        self.received = 0        # frames that made it through recv
+        self.applied = 0         # frames parsed and passed to useParsedData
+        self.ignored = 0         # unknown model, or a delta before the first full frame
+        self.dropped_bytes = 0
+        self.dropped_frames = 0  # frames that lost bytes in the receive buffer
+        self.late = 0
+        self.age_ms_max = 0.0
+        self.first_applied = None
+        self.last_applied = None
+        self.recent = deque()    # times of the frames applied within `window`
+
+    # bytes the line can deliver by `now`, callers reading a port take no more than this
+    def room(self, now):
+        start = now if self.wire_free is None else max(self.wire_free, now)
+        return max(0, int((now + HORIZON - start) / self.byte_time))
+
+    # bytes put on the wire at `now`, delivered one by one at the byte rate
+    def feed(self, data, now):
+        t = now if self.wire_free is None else max(self.wire_free, now)
+        for b in data:
+            t += self.byte_time
+            self._wire_byte(b)
+            self.run(t)
+            if len(self.rx) >= RX_BUFFER:
+                self.dropped_bytes += 1
+                if self.damaged != self.wire_frames:
+                    self.damaged = self.wire_frames
+                    self.dropped_frames += 1
+            else:
+                self.rx.append((b, t))
+        self.bytes += len(data)
+        self.wire_free = t
+        self.run(t)
+
+    def _wire_byte(self, b):
+        if not self.binary:
+            if b == 0x5B:
+                self.wire_frames += 1
+        elif self.wire_left:
+            self.wire_left -= 1
+        elif self.wire_len_next:
+            self.wire_left = b + 1
+            self.wire_len_next = False
+        elif b == SYNC:
+            self.wire_frames += 1
+            self.wire_len_next = True
+
+    # runs loop() up to time t, one frame per pass
+    def run(self, t):
+        self._telemetry(t)
+        while self.rx and self.busy_until <= t:
+            complete = False
+            while self.rx and not complete:
+                b, arrived = self.rx.popleft()
+                if self.frame_start is None:
+                    self.frame_start = arrived
+                complete = self.firmware.recv(b)
+            if not complete:
+                break
+            done = max(self.busy_until, arrived)
+            self._frame(done)
+            self.busy_until = done + self.process_time
+            self._telemetry(t)
+
+    def _frame(self, t):
+        self.received += 1
+        first, self.frame_start = self.frame_start, None
+        self._move(t)
+        applied = self.firmware.parse(self)
+        self.motors = use_parsed_data(self.ints, self.bools)  # runs for ignored frames too
+        if not applied:
+            self.ignored += 1
+            return
+        self.applied += 1
+        seq = self.firmware.seq if self.binary else None
+        if seq is not None:
+            self.reply(f'ACK {seq[0]} {seq[1]}\r\n'.encode())
+            age_ms = (int(1000 * t) - seq[1]) & 0xFFFF
+        else:
+            age_ms = 1000 * (t - first)
+        self.age_ms_max = max(self.age_ms_max, age_ms)
+        if age_ms > self.late_ms:
+            self.late += 1
+        if self.first_applied is None:
+            self.first_applied = t
+        self.last_applied = t
+        self.recent.append(t)
+        while self.recent[0] <= t - self.window:
+            self.recent.popleft()
+
+    # encoder counts follow the motor powers, -128 floats
+    def _move(self, t):
+        if self.moved is not None:
+            dt = t - self.moved
+            for k, power in enumerate(self.motors):
+                if power != -128:
+                    self.encoders[k] += power * dt * ENC_PER_POWER_S
+        self.moved = t
+
+    def _telemetry(self, t):
+        if not self.telemetry:
+            return
+        if self.next_telemetry is None:
+            self.next_telemetry = t + TELEMETRY_INTERVAL
+        while self.next_telemetry <= t:
+            start = max(self.busy_until, self.next_telemetry)
+            self._move(start)
+            self.busy_until = start + self.telemetry_time
+            self.next_telemetry = start + TELEMETRY_INTERVAL
+            self.reply(('ENC ' + ' '.join(str(int(v)) for v in self.encoders) + '\r\n').encode())
+            self.reply(('PWR ' + ' '.join(str(v) for v in self.motors) + '\r\n').encode())
+
+    def reply(self, data):
+        self.replies += data
+
+    def pop_replies(self):
+        data = bytes(self.replies)
+        self.replies.clear()
+        return data
+
+    def command_hz(self, now=None):
+        if now is not None:
+            while self.recent and self.recent[0] <= now - self.window:
+                self.recent.popleft()
+        return len(self.recent) / self.window
+
+    def stats(self, now=None):
+        span = (self.last_applied or 0.0) - (self.first_applied or 0.0)
+        stats = {
+            'bytes': self.bytes,
+            'wire_frames': self.wire_frames,
+            'received': self.received,
+            'applied': self.applied,
+            'ignored': self.ignored,
+            'dropped_bytes': self.dropped_bytes,
+            'dropped_frames': self.dropped_frames,
+            'late': self.late,
+            'age_ms_max': round(self.age_ms_max, 2),
+            'command_hz': self.command_hz(now),
+            'command_hz_avg': (self.applied - 1) / span if span > 0 else 0.0,
+            'motors': list(self.motors),
+        }
+        if self.binary:
+            stats |= {'crc_errors': self.firmware.crc_errors, 'unsynced': self.firmware.unsynced}
+        else:
+            stats |= {'truncated': self.firmware.truncated, 'missing_tokens': self.firmware.missing_tokens}
+        return stats
+
+
+# the far end of a pty, the topside opens `name`
+class PtyPort:
+    def __init__(self):
+        import tty
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # no echo, no line buffering
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self.slave)
+
+    def read(self, size):
+        try:
+            return os.read(self.master, size)
+        except OSError:  # nothing to read, or nobody has the pty open
+            return b''
+
+    def write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# feeds what arrives on `port` to `rov` at the line's pace and writes back its replies,
+# report(stats) is called every `interval` seconds
+def serve(port, rov, done=lambda: False, report=None, interval=1.0, poll=0.0005):
+    next_report = perf_counter() + interval
+    while not done():
+        now = perf_counter()
+        if (room := rov.room(now)) and (data := port.read(room)):
+            rov.feed(data, now)
+        else:
+            rov.run(now)
+        if rov.replies:
+            port.write(rov.pop_replies())
+        if report is not None and now >= next_report:
+            report(rov.stats(now))
+            next_report += interval
+        sleep(poll)
+
+
+def format_stats(stats):
+    line = (f"{stats['command_hz']:.1f} Hz: applied {stats['applied']} of {stats['wire_frames']} frames, "
+            f"dropped {stats['dropped_frames']} ({stats['dropped_bytes']} bytes), late {stats['late']} "
+            f"(max {stats['age_ms_max']:.1f} ms)")
+    if 'truncated' in stats:
+        line += f", truncated {stats['truncated']}, short {stats['missing_tokens']}"
+    else:
+        line += f", crc errors {stats['crc_errors']}, unsynced {stats['unsynced']}"
+    return line + f", motors {' '.join(str(v) for v in stats['motors'])}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HiTechnic.ino stand-in on a pty')
+    port_group = parser.add_mutually_exclusive_group()
+    port_group.add_argument('--com', help='serve this pyserial port / url instead of a new pty')
+    port_group.add_argument('--listen', help='serve tcp://host:port or udp://host:port (transport.py)')
+    parser.add_argument('--baud', type=int, default=9600, help="the firmware's Serial.begin rate")
+    parser.add_argument('--binary', action='store_true', help='USE_BINARY_FRAMES, for --protocol binary / delta')
+    parser.add_argument('--process-ms', type=float, default=2.0, help='loop time spent on each frame')
+    parser.add_argument('--telemetry', action='store_true', help='SEND_TELEMETRY true, send ENC / PWR lines')
+    parser.add_argument('--telemetry-ms', type=float, default=4.0, help='loop time spent on each round of telemetry')
+    parser.add_argument('--late-ms', type=float, default=50.0, help='frames acted on later than this are late')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between reports')
+    args = parser.parse_args(argv)
+
+    rov = VirtualROV(args.baud, args.binary, args.process_ms, args.late_ms, args.telemetry, args.telemetry_ms)
+    if args.listen:
+        from transport import listen
+
+        port = listen(args.listen)
+        name = port.address
+    elif args.com:
+        import serial
+
+        port = serial.serial_for_url(args.com, args.baud, timeout=0, write_timeout=0.1)
+        name = args.com
+    else:
+        port = PtyPort()
+        name = port.name
+    protocol = '--protocol binary' if args.binary else '--protocol text'
+    print(f'Virtual ROV on {name} at {args.baud} baud, try: python cli.py --com {name} --baud {args.baud} {protocol} --settle 0')
+    try:
+        serve(port, rov, report=lambda stats: print(format_stats(stats)), interval=args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        port.close()
+    print(format_stats(rov.stats(perf_counter())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())